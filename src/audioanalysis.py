@@ -6,9 +6,10 @@ import scipy
 import moviepy.editor as edit
 import matplotlib.pyplot as plt
 import pdb
-import scipy.signal as signal
 import os
 import argparse
+import subprocess as sp
+from moviepy.config import get_setting
 from frequencies import FREQUENCIES
 
 START_THRESHOLD = 0.02
@@ -21,6 +22,18 @@ SAMPLE_FREQUENCY = 44100
 
 AUDIO_START_THRESHOLD = 0.7
 
+# samples per second of the stored volume envelopes of clips
+ENVELOPE_RATE = 100
+
+# sample rate that clips are analysed at, lower it to trade
+# precision of the offsets for speed
+ANALYSIS_SAMPLE_RATE = SAMPLE_FREQUENCY
+
+# only the first this many seconds of a clip are analysed, which
+# speeds up long takes where the note is played early on. None
+# analyses the whole clip
+ANALYSIS_WINDOW = None
+
 
 def analyse_instrument(video, output_name):
     clips = _split_clip(video)
@@ -43,43 +56,142 @@ def find_offset_and_max_vol(clip):
     """
     Returns the amount of time in seconds before the note starts.
     """
-    audio = _extract_audio(clip)
-    
+    offset, max_vol, _ = analyse_clip(clip)
+    return offset, max_vol
+
+
+def _envelope(clip_abs, sample_rate):
+    block_size = max(1, int(sample_rate // ENVELOPE_RATE))
+    num_blocks = len(clip_abs) // block_size
+    blocks = clip_abs[:num_blocks*block_size].reshape((num_blocks, block_size))
+    return blocks.mean(axis=1)
+
+
+def read_audio(file_name, sample_rate=SAMPLE_FREQUENCY, max_duration=None):
+    """
+    Reads the audio of a media file as mono samples between -1 and 1,
+    streamed from ffmpeg without decoding any video. If max_duration is
+    given, ffmpeg stops after that many seconds.
+    """
+    a = _read_pcm(file_name, sample_rate, 0, max_duration)
+    return (a[:, 0].astype(np.float64) + a[:, 1])*(0.5/2**15)
+
+
+def read_stereo_audio(file_name, sample_rate=SAMPLE_FREQUENCY, start=0,
+                      max_duration=None):
+    """
+    Reads the audio of a media file from start seconds on as float32
+    stereo samples between -1 and 1, shaped (number of samples, 2).
+    """
+    a = _read_pcm(file_name, sample_rate, start, max_duration)
+    return a.astype(np.float32)*(1.0/2**15)
+
+
+def _read_pcm(file_name, sample_rate, start, max_duration):
+    cmd = [get_setting('FFMPEG_BINARY'), '-loglevel', 'error']
+    if start:
+        cmd.extend(['-ss', repr(float(start))])
+    cmd.extend(['-i', file_name, '-vn'])
+    if max_duration is not None:
+        cmd.extend(['-t', str(max_duration)])
+    cmd.extend(['-f', 's16le', '-acodec', 'pcm_s16le',
+                '-ar', str(sample_rate), '-ac', '2', '-'])
+    proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+    # both pipes are read at once, so that ffmpeg can't block on a full
+    # stderr pipe while stdout is read
+    data, err = proc.communicate()
+    if proc.returncode != 0:
+        raise IOError("Could not read the audio of {}: {}".format(file_name,
+                                                                  err))
+
+    return np.frombuffer(data, dtype=np.int16).reshape((-1, 2))
+
+
+def analyse_file(file_name, sample_rate=ANALYSIS_SAMPLE_RATE,
+                 window=ANALYSIS_WINDOW):
+    """
+    Returns the amount of time in seconds before the note starts,
+    the peak volume and the volume envelope (sampled at ENVELOPE_RATE)
+    of the audio of a media file.
+    """
+    audio = read_audio(file_name, sample_rate, window)
+    if len(audio) == 0:
+        raise Exception("{} has no audio".format(file_name))
+    return _analyse_audio(audio, sample_rate,
+                          float(len(audio))/sample_rate)
+
+
+def analyse_clip(clip):
+    """
+    Returns the amount of time in seconds before the note starts,
+    the peak volume and the volume envelope (sampled at ENVELOPE_RATE)
+    of the clip.
+    """
+    return _analyse_audio(_extract_audio(clip), clip.audio.fps, clip.duration)
+
+
+def _kernel_size(sample_rate):
+    """
+    Returns the size of the smoothing kernel, which is
+    KERNEL_SIZE samples at SAMPLE_FREQUENCY, at the given sample rate.
+    """
+    return max(1, int(round(KERNEL_SIZE*float(sample_rate)/SAMPLE_FREQUENCY)))
+
+
+def _moving_average(samples, kernel_size):
+    """
+    Returns the moving average of the samples over kernel_size samples,
+    centered like a convolution with a box kernel in 'same' mode but
+    computed from a cumulative sum in O(n) regardless of the kernel size.
+    """
+    cumsum = np.zeros(len(samples) + 1)
+    np.cumsum(samples, out=cumsum[1:])
+    last = np.arange(len(samples)) + (kernel_size - 1)//2 + 1
+    first = np.maximum(last - kernel_size, 0)
+    np.minimum(last, len(samples), out=last)
+    return (cumsum[last] - cumsum[first])/kernel_size
+
+
+def _analyse_audio(audio, sample_rate, tot_duration):
     clip_abs = np.abs(audio)
     max_vol = np.max(clip_abs)
-    kernel = np.ones((KERNEL_SIZE,))/KERNEL_SIZE
-    filtered = signal.convolve(clip_abs, kernel, mode='same')
+    filtered = _moving_average(clip_abs, _kernel_size(sample_rate))
     threshold = np.max(filtered)*AUDIO_START_THRESHOLD
-    tot_duration = clip.duration
-    i = 0
-    while i < len(filtered):
-        if filtered[i] >= threshold:
-            return float(i)*tot_duration/float(len(filtered)), max_vol
-        i += 1
-    # return float(np.argmax(clip_abs))*tot_duration/float(len(clip_abs)), max_vol
-
-    raise Exception("This should never happen")
+    # the first sample at the threshold, the maximum guarantees there is one
+    i = np.argmax(filtered >= threshold)
+    offset = float(i)*tot_duration/float(len(filtered))
+    return offset, max_vol, _envelope(clip_abs, sample_rate)
+
+
+def _find_sounds(filtered):
+    """
+    Returns the (start, end) indices of the sounds in the smoothed audio,
+    starting where it rises above START_THRESHOLD and ending right before
+    it falls back to END_THRESHOLD or below.
+    """
+    above_end = np.concatenate(([False], filtered > END_THRESHOLD, [False]))
+    changes = np.flatnonzero(above_end[1:] != above_end[:-1])
+    run_starts, run_ends = changes[::2], changes[1::2] - 1
+    above_start = np.flatnonzero(filtered > START_THRESHOLD)
+    if len(above_start) == 0:
+        return []
+
+    # the first index above the start threshold in every run above the
+    # end threshold, if there is one
+    first = np.searchsorted(above_start, run_starts)
+    has_start = first < len(above_start)
+    starts = above_start[np.minimum(first, len(above_start) - 1)]
+    has_start &= starts <= run_ends
+    return list(zip(starts[has_start], run_ends[has_start]))
     
 
 def _split_clip(video):
     # pdb.set_trace()
     audio = _extract_audio(video)
-    kernel = np.ones((KERNEL_SIZE,))/KERNEL_SIZE
     clip_abs = np.abs(audio)
-    filtered = signal.convolve(clip_abs, kernel, mode='same')
-    i = 0
-    indices = []
-
-    while i < len(filtered):
-        if filtered[i] > START_THRESHOLD:
-            start = i
-            while i < len(filtered) and filtered[i] > END_THRESHOLD:
-                i += 1
-            end = i - 1
-            indices.append((start, end))
-        else:
-            i += 1
-    
+    filtered = _moving_average(clip_abs, _kernel_size(video.audio.fps))
+    indices = _find_sounds(filtered)
+
     tot_duration = video.duration
     a_samples = float(len(filtered))
     return [video.subclip(tot_duration*float(start)/a_samples
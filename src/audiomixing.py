@@ -0,0 +1,44 @@
+import numpy as np
+from scipy.io import wavfile
+import audioanalysis
+
+SAMPLE_RATE = 44100
+
+
+def load_clip_audio(file_name, offset, max_duration, sample_rate=SAMPLE_RATE):
+    """
+    Returns the audio of a note clip from its offset on, at most
+    max_duration seconds of it, as float32 stereo samples.
+    """
+    return audioanalysis.read_stereo_audio(file_name, sample_rate,
+                                           offset, max_duration)
+
+
+def mix(sounds, duration, sample_rate=SAMPLE_RATE):
+    """
+    Mixes sounds, given as (samples, start, duration, gain) tuples with
+    the start and duration in seconds, into one buffer of duration seconds.
+    Every sound is cut off after its duration and added to its slice of the
+    buffer, scaled by its gain. Sounds that start before the buffer are cut
+    off at its start.
+    """
+    buf = np.zeros((int(np.ceil(duration*sample_rate)), 2), dtype=np.float32)
+    for samples, start, sound_duration, gain in sounds:
+        first = int(round(start*sample_rate))
+        skipped = max(0, -first)
+        num_samples = min(len(samples), int(round(sound_duration*sample_rate)),
+                          len(buf) - first) - skipped
+        if num_samples <= 0:
+            continue
+        buf[first + skipped:first + skipped + num_samples] += (
+            gain*samples[skipped:skipped + num_samples])
+    return buf
+
+
+def write_wav(file_name, samples, sample_rate=SAMPLE_RATE):
+    """
+    Writes float samples between -1 and 1 to a 16 bit wav file,
+    clipping whatever is louder.
+    """
+    pcm = np.clip(samples*2**15, -2**15, 2**15 - 1).astype(np.int16)
+    wavfile.write(file_name, sample_rate, pcm)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess as sp
+import tempfile
+import time
+
+import numpy as np
+from moviepy.config import get_setting
+import cliplibrary
+import filecache
+import midiparse
+import songcache
+import tracing
+import videocomposing
+import videowriter
+
+RESOLUTION = 480
+
+# the tempo changes of the benchmark songs, as (beat, bpm) pairs
+TEMPO_CHANGES = [(0, 120), (64, 90)]
+
+# the notes that every synthetic instrument can play
+NOTE_POOL = [48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67]
+
+# the synthetic note clips play a tone starting this many seconds in
+CLIP_ONSET = 0.3
+CLIP_DURATION = 1.5
+CLIP_SIZE = (160, 120)
+
+INSTRUMENT_NAME = 'Instrument{}'
+LIBRARY_DIR_NAME = 'library'
+MIDI_FILE_NAME = 'benchmark.mid'
+OUTPUT_FILE_NAME = 'output.mp4'
+
+
+def _variable_length(value):
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytearray(reversed(data))
+
+
+def _track_chunk(events):
+    """
+    Encodes (tick, event bytes) pairs, sorted by tick, as a track chunk.
+    """
+    data = bytearray()
+    last_tick = 0
+    for tick, event in events:
+        data += _variable_length(tick - last_tick) + event
+        last_tick = tick
+    data += _variable_length(0) + bytearray(b'\xff\x2f\x00')
+    return b'MTrk' + struct.pack('>L', len(data)) + bytes(data)
+
+
+def make_midi_file(file_name, num_tracks, num_notes, polyphony, rng):
+    """
+    Writes a midi file with num_tracks instruments that play num_notes notes
+    each, in chords of polyphony notes that partly overlap each other.
+    """
+    tempo_events = []
+    for beat, bpm in TEMPO_CHANGES:
+        mpqn = int(round(6e7/bpm))
+        tempo_events.append((beat*RESOLUTION, bytearray(
+            b'\xff\x51\x03' + struct.pack('>L', mpqn)[1:])))
+    chunks = [_track_chunk(tempo_events)]
+
+    for i in range(num_tracks):
+        name = INSTRUMENT_NAME.format(i)
+        # (tick, is note on, event bytes), so that notes that end at the
+        # same tick as others start end first
+        events = [(0, False, bytearray(b'\xff\x03') +
+                   _variable_length(len(name)) + bytearray(name.encode()))]
+        channel = i % 16
+        tick = 0
+        notes_left = num_notes
+        while notes_left > 0:
+            duration = rng.choice([1, 2, 4])*RESOLUTION//2
+            chord_size = min(polyphony, notes_left)
+            for pitch in rng.sample(NOTE_POOL, chord_size):
+                velocity = rng.randint(40, 127)
+                events.append((tick, True, bytearray(
+                    [0x90 | channel, pitch, velocity])))
+                events.append((tick + duration, False, bytearray(
+                    [0x80 | channel, pitch, 0])))
+            notes_left -= chord_size
+            tick += rng.randint(duration//2, duration)
+        events.sort(key=lambda e: (e[0], e[1]))
+        chunks.append(_track_chunk([(t, e) for t, _, e in events]))
+
+    with open(file_name, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>LHHH', 6, 1, len(chunks), RESOLUTION))
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def _make_note_clip(file_name, pitch):
+    frequency = 440.0*2**((pitch - 69)/12.0)
+    cmd = [get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+           '-f', 'lavfi', '-i', 'testsrc2=s={}x{}:r=30:d={}'.format(
+               CLIP_SIZE[0], CLIP_SIZE[1], CLIP_DURATION),
+           '-f', 'lavfi', '-i', 'sine=frequency={}:sample_rate=44100'
+           ':duration={}'.format(frequency, CLIP_DURATION - CLIP_ONSET),
+           '-filter_complex',
+           '[0:v]hue=h={}[v];[1:a]adelay={},volume=0.5,'
+           'aformat=channel_layouts=stereo[a]'.format(
+               pitch*30 % 360, int(CLIP_ONSET*1000)),
+           '-map', '[v]', '-map', '[a]', '-c:v', 'libx264',
+           '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+           '-t', str(CLIP_DURATION), file_name]
+    sp.check_call(cmd)
+
+
+def _make_note_clip_job(args):
+    _make_note_clip(*args)
+
+
+def make_library(library_dir, num_tracks):
+    """
+    Creates a clip of every note in NOTE_POOL for every instrument: a test
+    pattern, tinted by the pitch, with a tone that starts at CLIP_ONSET.
+    """
+    jobs = []
+    for i in range(num_tracks):
+        instrument_dir = os.path.join(library_dir, INSTRUMENT_NAME.format(i))
+        os.makedirs(instrument_dir)
+        for pitch in NOTE_POOL:
+            file_name = os.path.join(
+                instrument_dir,
+                midiparse.note_number_to_note_string(pitch) + '.mp4')
+            jobs.append((file_name, pitch))
+    pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    try:
+        pool.map(_make_note_clip_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _git_commit():
+    try:
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        return sp.check_output(['git', 'rev-parse', 'HEAD'], cwd=src_dir,
+                               stderr=sp.STDOUT).strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def _render_stats(events, process_names):
+    """
+    Returns the rendering speed of every segment, from the 'render segment'
+    spans of the processes that rendered them.
+    """
+    segments = []
+    for event in events:
+        if event['name'] != 'render segment':
+            continue
+        seconds = event['dur']/1e6
+        frames = event['args']['frames']
+        segments.append({
+            'name': process_names.get(event['pid']),
+            'frames': frames,
+            'seconds': seconds,
+            'fps': frames/max(seconds, 1e-9),
+        })
+    return sorted(segments, key=lambda s: s['name'])
+
+
+def run_benchmark(num_tracks, num_notes, polyphony, width, height, seed,
+                  num_threads):
+    """
+    Composes a synthetic song in the current directory like main.py does,
+    and times every stage from the tracing spans that it records. Returns
+    the results as a dictionary.
+    """
+    rng = random.Random(seed)
+    make_midi_file(MIDI_FILE_NAME, num_tracks, num_notes, polyphony, rng)
+    make_library(LIBRARY_DIR_NAME, num_tracks)
+
+    tracing.enable()
+    with tracing.span('load song'):
+        song = songcache.load_song(MIDI_FILE_NAME,
+                                   videocomposing.SONG_CACHE_DIR)
+    with tracing.span('compose'):
+        final_clip = videocomposing.compose(song, width, height,
+                                            LIBRARY_DIR_NAME, None,
+                                            num_threads, None)
+    videowriter.write_clip(final_clip, OUTPUT_FILE_NAME)
+    events, _, process_names, _ = tracing.take()
+
+    # the stages are the spans of this process, the ones of the workers
+    # overlap each other, along with the times that the spans measure
+    # in parts, like compositing and encoding the final video
+    pid = os.getpid()
+    stages = {}
+    for event in events:
+        if event['pid'] != pid:
+            continue
+        stages[event['name']] = (stages.get(event['name'], 0) +
+                                 event['dur']/1e6)
+        for name, value in event['args'].items():
+            if name.endswith(' seconds'):
+                name = name[:-len(' seconds')]
+                stages[name] = stages.get(name, 0) + value
+
+    library = cliplibrary.ClipLibrary(videocomposing.LIBRARY_FILE_NAME)
+    onset_errors = []
+    for instrument in os.listdir(LIBRARY_DIR_NAME):
+        instrument_dir = os.path.join(LIBRARY_DIR_NAME, instrument)
+        for clip_file_name in os.listdir(instrument_dir):
+            clip = library.get_clip(os.path.join(instrument_dir,
+                                                 clip_file_name))
+            if clip.is_analysed():
+                onset_errors.append(abs(clip.offset - CLIP_ONSET))
+
+    return {
+        'parameters': {
+            'tracks': num_tracks,
+            'notes': num_notes,
+            'polyphony': polyphony,
+            'resolution': [width, height],
+            'seed': seed,
+            'threads': num_threads,
+        },
+        'commit': _git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'stages': stages,
+        'segments': _render_stats(events, process_names),
+        'onset_error': {
+            'mean': float(np.mean(onset_errors)),
+            'max': float(np.max(onset_errors)),
+        },
+    }
+
+
+def print_results(results):
+    print("{:<20}{:>10}".format('Stage', 'Seconds'))
+    for stage, seconds in sorted(results['stages'].items(),
+                                 key=lambda s: -s[1]):
+        print("{:<20}{:>10.3f}".format(stage, seconds))
+    print("\n{:<38}{:>8}{:>10}".format('Segment', 'Frames', 'FPS'))
+    for segment in results['segments']:
+        print("{:<38}{:>8}{:>10.1f}".format(str(segment['name'])[:37],
+                                            segment['frames'],
+                                            segment['fps']))
+    print("\nOnset error: {:.3f} s mean, {:.3f} s max".format(
+        results['onset_error']['mean'], results['onset_error']['max']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times every stage of composing a synthetic song.')
+    parser.add_argument('--tracks', type=int, default=4,
+                        help='Number of instruments in the song')
+    parser.add_argument('--notes', type=int, default=200,
+                        help='Number of notes every instrument plays')
+    parser.add_argument('--polyphony', type=int, default=2,
+                        help='Number of notes in every chord')
+    parser.add_argument('-r', '--resolution', type=str, default='640x360',
+                        help='Resolution of output, like 1920x1080')
+    parser.add_argument('-t', '--threads', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Maximum number of concurrently rendered '
+                             'segments, all cores by default')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generated song')
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('--work-dir', type=str,
+                        help='Directory to generate the song and library in, '
+                             'a temporary directory by default')
+    args = parser.parse_args()
+
+    if not 1 <= args.polyphony <= len(NOTE_POOL):
+        parser.error("Polyphony must be between 1 and {}".format(
+            len(NOTE_POOL)))
+
+    output_file_name = os.path.abspath(args.output)
+    width, height = [int(x) for x in args.resolution.split('x')]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark')
+    filecache.make_dir(work_dir)
+    if os.path.exists(os.path.join(work_dir, LIBRARY_DIR_NAME)):
+        parser.error("Work directory \"{}\" is already used".format(work_dir))
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        results = run_benchmark(args.tracks, args.notes, args.polyphony,
+                                width, height, args.seed, args.threads)
+    finally:
+        os.chdir(cwd)
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    with open(output_file_name, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
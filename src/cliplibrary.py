@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import time
+
+import numpy as np
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+import filecache
+
+# seconds to wait for other processes to finish writing to the library
+DB_TIMEOUT = 60
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        hash TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS clips (
+        hash TEXT PRIMARY KEY,
+        duration REAL NOT NULL,
+        fps REAL,
+        width INTEGER,
+        height INTEGER,
+        has_audio INTEGER NOT NULL,
+        offset REAL,
+        max_vol REAL,
+        envelope BLOB
+    )
+    """,
+]
+
+
+def _initialize(connection):
+    # switching to WAL mode needs an exclusive lock, and sqlite doesn't
+    # wait for other processes that are creating the database at the
+    # same time, so retry until the timeout
+    deadline = time.time() + DB_TIMEOUT
+    while True:
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+            return
+        except sqlite3.OperationalError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+class ClipInfo:
+    """
+    Everything known about a note clip without opening it.
+    The offset, max_vol and envelope are None until the clip is analysed.
+    """
+
+    def __init__(self, file_name, file_hash, duration, fps, width, height,
+                 has_audio, offset=None, max_vol=None, envelope=None):
+        self.file_name = file_name
+        self.hash = file_hash
+        self.duration = duration
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.has_audio = has_audio
+        self.offset = offset
+        self.max_vol = max_vol
+        self.envelope = envelope
+
+    def is_analysed(self):
+        return self.offset is not None
+
+    def __repr__(self):
+        return "{} ({}x{}, {} s, offset: {})".format(
+            self.file_name, self.width, self.height,
+            self.duration, self.offset)
+
+
+class ClipLibrary:
+    """
+    Index of all note clips ever used, stored in an SQLite database.
+    Clips are identified by the hash of their contents, so that the same
+    recording is only probed and analysed once, no matter how many
+    instruments use it. Safe to use from several processes at once.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        # connections can't be shared between processes
+        return {'file_name': self.file_name}
+
+    def __setstate__(self, state):
+        self.__init__(state['file_name'])
+
+    def _connect(self):
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.file_name, timeout=DB_TIMEOUT)
+            _initialize(connection)
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _get_hash(self, file_name):
+        connection = self._connect()
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        row = connection.execute(
+            'SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?',
+            (path, stat.st_size, stat.st_mtime)).fetchone()
+        if row is not None:
+            return row[0]
+
+        file_hash = filecache.file_hash(path)
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime, file_hash))
+        return file_hash
+
+    def get_clip(self, file_name):
+        """
+        Returns the ClipInfo of a video file, probing
+        its metadata if the file hasn't been seen before.
+        """
+        connection = self._connect()
+        file_hash = self._get_hash(file_name)
+        row = connection.execute(
+            'SELECT duration, fps, width, height, has_audio, '
+            'offset, max_vol, envelope FROM clips WHERE hash = ?',
+            (file_hash,)).fetchone()
+
+        if row is None:
+            infos = ffmpeg_parse_infos(file_name)
+            width, height = infos.get('video_size', (None, None))
+            row = (infos['duration'], infos.get('video_fps'), width, height,
+                   int(infos['audio_found']), None, None, None)
+            with connection:
+                connection.execute(
+                    'INSERT OR IGNORE INTO clips '
+                    '(hash, duration, fps, width, height, has_audio) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (file_hash,) + row[:5])
+
+        duration, fps, width, height, has_audio, offset, max_vol, envelope = row
+        if envelope is not None:
+            envelope = np.frombuffer(envelope, dtype=np.float32)
+        return ClipInfo(file_name, file_hash, duration, fps, width, height,
+                        bool(has_audio), offset, max_vol, envelope)
+
+    def store_analysis(self, clip, offset, max_vol, envelope=None):
+        """
+        Stores the results of the audio analysis of a clip.
+        """
+        offset, max_vol = float(offset), float(max_vol)
+        blob = None
+        if envelope is not None:
+            envelope = np.asarray(envelope, dtype=np.float32)
+            blob = sqlite3.Binary(envelope.tostring())
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                'UPDATE clips SET offset = ?, max_vol = ?, envelope = ? '
+                'WHERE hash = ?', (offset, max_vol, blob, clip.hash))
+        clip.offset = offset
+        clip.max_vol = max_vol
+        clip.envelope = envelope
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess as sp
+
+from moviepy.config import get_setting
+import audioanalysis
+import cliplibrary
+import filecache
+import midiparse
+import videocomposing
+
+# the peak volume that all compiled clips are normalized to
+TARGET_PEAK_VOLUME = 0.5
+
+# every frame of a compiled clip is a key frame, so that any frame can be
+# read without decoding the ones before it
+VIDEO_CODEC_OPTIONS = ['-c:v', 'libx264', '-preset', 'medium', '-crf', '18',
+                       '-g', '1', '-pix_fmt', 'yuv420p']
+AUDIO_CODEC_OPTIONS = ['-c:a', 'aac', '-b:a', '192k']
+
+# written to the output directory when compiling instruments from a
+# config, mapping the instruments to their compiled clips
+CONFIG_FILE_NAME = 'instruments.json'
+
+
+def _find_instrument_dirs(source_dir, instrument_config):
+    """
+    Returns {normalized instrument directory: name of its compiled
+    directory}. The compiled directories are named like the instrument
+    directories, so these must have different names.
+    """
+    if instrument_config is not None:
+        instrument_dirs = {}
+        for path in sorted(set(os.path.normpath(path)
+                               for path in instrument_config.values())):
+            name = os.path.basename(path)
+            if name in instrument_dirs.values():
+                raise ValueError("More than one instrument directory is "
+                                 "named \"{}\"".format(name))
+            instrument_dirs[path] = name
+        return instrument_dirs
+    return {os.path.join(source_dir, name): name
+            for name in sorted(os.listdir(source_dir))
+            if os.path.isdir(os.path.join(source_dir, name))}
+
+
+def _compile_clip(args):
+    """
+    Writes a note clip from its onset on, with its volume scaled by gain
+    and its video downscaled to fit in max_size.
+    """
+    clip, gain, max_size, file_name = args
+    width, height = max_size
+    scale = ("scale='min({},iw)':'min({},ih)':force_original_aspect_ratio="
+             "decrease:force_divisible_by=2".format(width, height))
+    tmp_file_name = filecache.temporary_file_name(file_name)
+    cmd = [get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+           '-ss', repr(float(clip.offset)), '-i', clip.file_name,
+           '-vf', scale, '-threads', '1'] + VIDEO_CODEC_OPTIONS
+    if clip.has_audio:
+        cmd += ['-af', 'volume={!r}'.format(gain)] + AUDIO_CODEC_OPTIONS
+    cmd += ['-movflags', '+faststart', tmp_file_name]
+    sp.check_call(cmd)
+    filecache.publish(tmp_file_name, file_name)
+
+
+def compile_library(source_dir, instrument_config, output_dir, max_size,
+                    force=False):
+    """
+    Compiles the note clips of every instrument into output_dir, laid out
+    like source_dir: every clip is trimmed at the onset of its note,
+    normalized to TARGET_PEAK_VOLUME, downscaled to fit in max_size and
+    encoded with only key frames. The analysis of the compiled clips is
+    known from the analysis of the originals, and is stored in the clip
+    library so that renders don't analyse them again. Clips that are
+    already compiled and newer than their originals are skipped unless
+    force is given.
+    """
+    videocomposing._create_working_dir()
+    library = cliplibrary.ClipLibrary(videocomposing.LIBRARY_FILE_NAME)
+    instrument_dirs = _find_instrument_dirs(source_dir, instrument_config)
+
+    # every tone of every instrument directory, analysed like in a render
+    instruments = {}
+    for path in instrument_dirs:
+        tones = videocomposing._get_available_tones(path)
+        if tones:
+            instruments[path] = [midiparse.note_string_to_note_number(tone)
+                                 for tone in tones]
+    config = {path: path for path in instrument_dirs}
+    instrument_clips = videocomposing._load_instrument_clips(
+        instruments, None, config, library)
+
+    jobs = []
+    # [(compiled file name, original ClipInfo, gain)]
+    compiled_clips = []
+    for path, (clips, _) in instrument_clips.items():
+        compiled_dir = os.path.join(output_dir, instrument_dirs[path])
+        filecache.make_dir(compiled_dir)
+        for clip in clips.values():
+            file_name = os.path.join(compiled_dir,
+                                     os.path.basename(clip.file_name))
+            gain = TARGET_PEAK_VOLUME/max(clip.max_vol, 1e-6)
+            compiled_clips.append((file_name, clip, gain))
+            if (force or not os.path.isfile(file_name) or
+                    os.path.getmtime(file_name) < os.path.getmtime(
+                        clip.file_name)):
+                jobs.append((clip, gain, max_size, file_name))
+
+    if jobs:
+        print("Compiling {} note clips".format(len(jobs)))
+        pool = multiprocessing.Pool(multiprocessing.cpu_count())
+        try:
+            pool.map(_compile_clip, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    for file_name, clip, gain in compiled_clips:
+        compiled_clip = library.get_clip(file_name)
+        if compiled_clip.is_analysed() and not force:
+            continue
+        envelope = None
+        if clip.envelope is not None:
+            first = int(round(clip.offset*audioanalysis.ENVELOPE_RATE))
+            envelope = clip.envelope[first:]*gain
+        library.store_analysis(compiled_clip, 0.0, clip.max_vol*gain,
+                               envelope)
+
+    if instrument_config is not None:
+        compiled_config = {name: os.path.abspath(os.path.join(
+                               output_dir,
+                               instrument_dirs[os.path.normpath(path)]))
+                           for name, path in instrument_config.items()}
+        with open(os.path.join(output_dir, CONFIG_FILE_NAME), 'w') as f:
+            json.dump(compiled_config, f, indent=4, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compiles note clips into small clips that start at '
+                    'their notes, for faster rendering.')
+    parser.add_argument('-s', '--source', type=str,
+                        help='Path to directory where videos of the '
+                             'instruments can be found.')
+    parser.add_argument('-c', '--config', type=str,
+                        help='JSON file with instrument names mapped to the '
+                             'path to their locations.')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Directory to write the compiled clips to')
+    parser.add_argument('--max-size', type=str, default='1920x1080',
+                        help='Largest size of the compiled clips, like '
+                             '640x360. Use the largest tile the clips '
+                             'will be shown in')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Compile clips that are already compiled')
+    args = parser.parse_args()
+
+    if args.source is None and args.config is None:
+        parser.error("Either source dir (-s) or instrument config (-c) "
+                     "required")
+    if args.source is not None and not os.path.isdir(args.source):
+        parser.error("Source directory \"{}\" not found".format(args.source))
+    if args.config is not None and not os.path.isfile(args.config):
+        parser.error("Instrument config file \"{}\" not found".format(
+            args.config))
+
+    max_size = [int(x) for x in args.max_size.split('x')]
+    compile_library(args.source,
+                    videocomposing._try_load_json_file(args.config),
+                    args.output, max_size, args.force)
+
+
+if __name__ == '__main__':
+    main()
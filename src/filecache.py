@@ -0,0 +1,99 @@
+import hashlib
+import os
+import time
+
+# temporary files older than this (in seconds) are left
+# behind by crashed processes and can be removed
+STALE_TEMPORARY_FILE_AGE = 24*60*60
+
+TEMPORARY_FILE_MARKER = '.tmp'
+
+# {(file name, size, mtime): sha1 of the contents}
+_file_hashes = {}
+
+
+def make_dir(cache_dir):
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # another process created it
+            pass
+
+
+def temporary_file_name(file_name):
+    """
+    Returns a file name, unique to this process, to write an entry to
+    before publishing it as file_name. The extension is kept so that
+    tools that look at it keep working.
+    """
+    root, ext = os.path.splitext(file_name)
+    return '{}{}{}{}'.format(root, TEMPORARY_FILE_MARKER, os.getpid(), ext)
+
+
+def publish(temporary_file, file_name):
+    """
+    Atomically moves a completely written entry to its final name,
+    so that no other process ever sees a partially written entry.
+    """
+    os.rename(temporary_file, file_name)
+
+
+def touch(file_name):
+    """
+    Marks an entry as recently used.
+    """
+    os.utime(file_name, None)
+
+
+def file_hash(file_name):
+    """
+    Returns the sha1 hash of the contents of a file.
+    """
+    stat = os.stat(file_name)
+    key = (os.path.abspath(file_name), stat.st_size, stat.st_mtime)
+    if key not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                sha1.update(chunk)
+        _file_hashes[key] = sha1.hexdigest()
+    return _file_hashes[key]
+
+
+def evict(cache_dir, max_size, extension):
+    """
+    Removes the least recently used entries with the given extension
+    until they take up no more than max_size bytes, as well as
+    temporary files left behind by crashed processes.
+    """
+    entries = []
+    total_size = 0
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if TEMPORARY_FILE_MARKER in name:
+            if now - stat.st_mtime > STALE_TEMPORARY_FILE_AGE:
+                _try_remove(path)
+        elif name.endswith(extension):
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+    entries.sort()
+    for _, entry_size, path in entries:
+        if total_size <= max_size:
+            break
+        # processes that have the entry open can keep reading it
+        _try_remove(path)
+        total_size -= entry_size
+
+
+def _try_remove(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
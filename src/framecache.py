@@ -0,0 +1,193 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import filecache
+import tracing
+from moviepy.video.fx.resize import resizer
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+
+# the cache is trimmed to this size after every insertion,
+# evicting the least recently used entries first
+MAX_CACHE_SIZE = 4*1024**3
+
+CACHE_EXTENSION = '.npy'
+
+# the filters that frames can be resized with, smooth filtering
+# or picking the nearest pixel, which is faster
+RESIZE_SMOOTH = 'smooth'
+RESIZE_NEAREST = 'nearest'
+
+# the number of video readers, each an ffmpeg process, that a process
+# keeps open. The least recently used one is closed when another is needed
+MAX_OPEN_READERS = 4
+
+# entries already opened by this process, {key: frames}
+_opened_entries = {}
+
+# {file name: FFMPEG_VideoReader} open in this process, least recently
+# used first, and the process they belong to
+_open_readers = OrderedDict()
+_readers_pid = None
+
+
+def set_max_open_readers(max_open_readers):
+    global MAX_OPEN_READERS
+    MAX_OPEN_READERS = max_open_readers
+    _close_readers(max_open_readers)
+
+
+def close_readers():
+    """
+    Closes the readers that this process has open. Clips are read once per
+    process for all the sizes they're needed at, so a process that is done
+    decoding has no use for them.
+    """
+    _close_readers(0)
+
+
+def _close_readers(max_open_readers):
+    global _open_readers, _readers_pid
+    if _readers_pid != os.getpid():
+        # the readers of the parent of a forked process are left to it
+        _open_readers = OrderedDict()
+        _readers_pid = os.getpid()
+    while len(_open_readers) > max_open_readers:
+        _, reader = _open_readers.popitem(last=False)
+        reader.close()
+
+
+def _get_reader(file_name):
+    """
+    Returns a reader of a video file, reusing the one this process has
+    open if there is one, so that reading on from where it stopped
+    doesn't start a new ffmpeg process.
+    """
+    _close_readers(MAX_OPEN_READERS)
+    reader = _open_readers.pop(file_name, None)
+    tracing.count('reader', reader is not None)
+    if reader is None:
+        _close_readers(max(MAX_OPEN_READERS - 1, 0))
+        reader = FFMPEG_VideoReader(file_name)
+    _open_readers[file_name] = reader
+    return reader
+
+
+def _entry_key(clip, size, fps, resize_filter):
+    description = '{}:{!r}:{}x{}:{}'.format(clip.hash, clip.offset,
+                                            size[0], size[1], fps)
+    if resize_filter != RESIZE_SMOOTH:
+        description += ':' + resize_filter
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def _clip_num_frames(clip, fps, num_frames):
+    return max(1, min(num_frames, int((clip.duration - clip.offset)*fps)))
+
+
+def _entry_file_name(cache_dir, clip, size, fps, resize_filter):
+    return os.path.join(cache_dir, _entry_key(clip, size, fps, resize_filter) +
+                        CACHE_EXTENSION)
+
+
+def is_cached(cache_dir, clip, size, fps, num_frames,
+              resize_filter=RESIZE_SMOOTH):
+    """
+    Returns whether get_frames would find the frames in the cache.
+    """
+    num_frames = _clip_num_frames(clip, fps, num_frames)
+    file_name = _entry_file_name(cache_dir, clip, size, fps, resize_filter)
+    try:
+        return len(np.load(file_name, mmap_mode='r')) >= num_frames
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def cache_frames(cache_dir, clip, sizes, fps, num_frames,
+                 resize_filter=RESIZE_SMOOTH):
+    """
+    Stores the first num_frames frames of the clip at all of the given
+    sizes, decoding the clip once and resizing every frame to every size.
+    """
+    num_frames = _clip_num_frames(clip, fps, num_frames)
+    for _ in sizes:
+        tracing.count('frame', False)
+    _decode_frames(cache_dir, clip, sizes, fps, num_frames, resize_filter)
+    filecache.evict(cache_dir, MAX_CACHE_SIZE, CACHE_EXTENSION)
+
+
+def get_frames(cache_dir, clip, size, fps, num_frames,
+               resize_filter=RESIZE_SMOOTH):
+    """
+    Returns an array with the first num_frames frames of the analysed clip
+    (a ClipInfo), starting at its offset and resized to size = (width,
+    height). The frames are decoded once and stored in a memory-mapped file
+    in cache_dir, which all processes rendering the same clip at the same
+    size share. If the clip is too short, all frames until its end are
+    returned. The frames are resized with resize_filter, one of the RESIZE_
+    constants.
+    """
+    num_frames = _clip_num_frames(clip, fps, num_frames)
+    key = _entry_key(clip, size, fps, resize_filter)
+
+    frames = _opened_entries.get(key)
+    if frames is not None and len(frames) >= num_frames:
+        tracing.count('frame', True)
+        return frames
+
+    file_name = _entry_file_name(cache_dir, clip, size, fps, resize_filter)
+    try:
+        frames = np.load(file_name, mmap_mode='r')
+        if len(frames) >= num_frames:
+            filecache.touch(file_name)
+            _opened_entries[key] = frames
+            tracing.count('frame', True)
+            return frames
+    except (IOError, OSError, ValueError):
+        pass
+
+    tracing.count('frame', False)
+    frames = _decode_frames(cache_dir, clip, [size], fps, num_frames,
+                            resize_filter)[0]
+    _opened_entries[key] = frames
+    filecache.evict(cache_dir, MAX_CACHE_SIZE, CACHE_EXTENSION)
+    return frames
+
+
+def _resize_nearest(frame, size):
+    width, height = size
+    rows = np.arange(height)*frame.shape[0]//height
+    columns = np.arange(width)*frame.shape[1]//width
+    return frame[np.ix_(rows, columns)]
+
+
+def _decode_frames(cache_dir, clip, sizes, fps, num_frames, resize_filter):
+    """
+    Decodes the frames of a clip into the cache at all sizes, and returns
+    the cached frames of every size.
+    """
+    filecache.make_dir(cache_dir)
+    file_names = [_entry_file_name(cache_dir, clip, size, fps, resize_filter)
+                  for size in sizes]
+    tmp_file_names = [filecache.temporary_file_name(f) for f in file_names]
+    all_frames = [np.lib.format.open_memmap(tmp_file_name, mode='w+',
+                                            dtype=np.uint8,
+                                            shape=(num_frames, height,
+                                                   width, 3))
+                  for tmp_file_name, (width, height) in zip(tmp_file_names,
+                                                            sizes)]
+    resize = _resize_nearest if resize_filter == RESIZE_NEAREST else resizer
+    reader = _get_reader(clip.file_name)
+    for i in range(num_frames):
+        frame = reader.get_frame(clip.offset + float(i)/fps)
+        for frames, size in zip(all_frames, sizes):
+            frames[i] = resize(frame, size)
+
+    for frames, tmp_file_name, file_name in zip(all_frames, tmp_file_names,
+                                                file_names):
+        frames.flush()
+        filecache.publish(tmp_file_name, file_name)
+    del all_frames
+    return [np.load(file_name, mmap_mode='r') for file_name in file_names]
+
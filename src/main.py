@@ -1,12 +1,15 @@
 #!/usr/bin/python
 
-import midi
 import argparse
 import pdb
 import sys
 import os
 import midiparse
+import songcache
+import framecache
+import tracing
 import videocomposing
+import videowriter
 import moviepy.editor as edit
 
 
@@ -19,10 +22,15 @@ TERM_ENDC = '\033[0m'
 TERM_BOLD = '\033[1m'
 TERM_UNDERLINE = '\033[4m'
 
+# the draft profile renders previews at most this wide,
+# with the fastest preset of the encoder
+DRAFT_MAX_WIDTH = 640
+DRAFT_PRESET = 'ultrafast'
 
-def print_instruments(pattern):
-    instruments = midiparse.get_instruments(pattern)
-    song_name = midiparse.get_song_name(pattern)
+
+def print_instruments(song):
+    instruments = song.get_instruments()
+    song_name = song.name
     
     if song_name is not None:
         print "Song \'{}\':".format(song_name)
@@ -35,6 +43,21 @@ def print_instruments(pattern):
         print ""
 
 
+def parse_time(value, song):
+    """
+    Converts a time in the song, given in seconds like 12.5 or as the
+    start of a bar like 40b, where the first bar is 1b, to seconds. Bars
+    follow the time signature changes of the song.
+    """
+    if value.endswith('b'):
+        bar = int(value[:-1])
+        if bar < 1:
+            raise ValueError("Bars are counted from 1")
+        tick = song.bar_to_tick(bar)
+        return float(song.get_tempo_map().to_seconds(tick))
+    return float(value)
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -52,6 +75,33 @@ def main():
     parser.add_argument('-r', '--resolution', type=str, 
                         help='Resolution of output, like 1920x1080',
                         default='1920x1080')
+    parser.add_argument('--start', type=str,
+                        help='Only render from this time, in seconds like '
+                             '12.5 or as the start of a bar like 40b')
+    parser.add_argument('--end', type=str,
+                        help='Only render until this time, in seconds like '
+                             '20 or as the start of a bar like 42b')
+    parser.add_argument('--draft', action='store_true',
+                        help='Render a quick preview at a lower quality')
+    parser.add_argument('--codec', type=str,
+                        default=videowriter.DEFAULT_CODEC,
+                        help='ffmpeg codec of the output video')
+    parser.add_argument('--preset', type=str,
+                        help='Encoder preset of the output video, ' +
+                             videowriter.DEFAULT_PRESET + ' by default')
+    parser.add_argument('--crf', type=int,
+                        help='Constant rate factor of the output video, '
+                             'lower is better quality')
+    parser.add_argument('--encoder-threads', type=int,
+                        help='Number of threads encoding the output video, '
+                             'all cores by default')
+    parser.add_argument('--max-decoders', type=int,
+                        default=framecache.MAX_OPEN_READERS,
+                        help='Maximum number of note clips that every '
+                             'process keeps open for decoding')
+    parser.add_argument('--trace', type=str,
+                        help='Record the time spent in every stage and '
+                             'write it to this Chrome trace file')
 
     args = parser.parse_args()
 
@@ -77,24 +127,57 @@ def main():
                                           os.path.isfile(instrument_config_file)):
         parser.error("Instrument config file \"{}\" not found".format(instrument_config))
 
-    pattern = midi.read_midifile(midifile)
-    pattern.make_ticks_abs()
-
-    instrument_clips = {}
+    if args.max_decoders < 1:
+        parser.error("At least one decoder is needed")
+    framecache.set_max_open_readers(args.max_decoders)
+
+    if args.trace is not None:
+        tracing.enable()
+
+    with tracing.span('load song'):
+        song = songcache.load_song(midifile, videocomposing.SONG_CACHE_DIR)
+
+    time_range = None
+    if args.start is not None or args.end is not None:
+        try:
+            start = 0.0
+            if args.start is not None:
+                start = parse_time(args.start, song)
+            end = None
+            if args.end is not None:
+                end = parse_time(args.end, song)
+        except ValueError:
+            parser.error("Times are given in seconds like 12.5, or as the "
+                         "start of a bar like 40b")
+        if end is not None and end <= start:
+            parser.error("The end must come after the start")
+        time_range = (start, end)
 
     if args.instruments:
-        print_instruments(pattern)
+        print_instruments(song)
     else:
-        # load the that each instrument plays
-        instruments = midiparse.get_instruments(pattern)
-
-        w_res, h_res = args.resolution.split('x')
-        final_clip = videocomposing.compose(instruments, pattern,
-                                            int(w_res), int(h_res), source_dir,
-                                            volume_file, args.threads,
-                                            instrument_config_file)
-                                           # 640, 360, source_dir, volume_file)
-        final_clip.write_videofile('output.mp4')
+        w_res, h_res = [int(x) for x in args.resolution.split('x')]
+        preset = videowriter.DEFAULT_PRESET
+        if args.draft:
+            preset = DRAFT_PRESET
+            if w_res > DRAFT_MAX_WIDTH:
+                # the encoder needs an even height
+                h_res = h_res*DRAFT_MAX_WIDTH//w_res//2*2
+                w_res = DRAFT_MAX_WIDTH
+        if args.preset is not None:
+            preset = args.preset
+        with tracing.span('compose'):
+            final_clip = videocomposing.compose(song, w_res, h_res,
+                                                source_dir, volume_file,
+                                                args.threads,
+                                                instrument_config_file,
+                                                time_range, args.draft)
+        videowriter.write_clip(final_clip, 'output.mp4', args.codec, preset,
+                               args.crf, args.encoder_threads)
+
+    if args.trace is not None:
+        tracing.write_trace(args.trace)
+        tracing.print_summary()
 
     sys.exit(0)
 
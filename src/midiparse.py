@@ -1,10 +1,33 @@
+import math
 import pdb
-import midi
+import struct
+import numpy as np
+from collections import deque
+import tracing
 
 TONES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 
 DEFAULT_TEMPO = 96
 
+# the time signature of songs until their first time signature change,
+# as (numerator, denominator)
+DEFAULT_TIME_SIGNATURE = (4, 4)
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+
+META_EVENT = 0xFF
+META_TRACK_NAME = 0x03
+META_SET_TEMPO = 0x51
+META_TIME_SIGNATURE = 0x58
+
+SYSEX_EVENTS = (0xF0, 0xF7)
+
+# number of data bytes of the channel messages, by the upper half
+# of their status byte
+CHANNEL_MESSAGE_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2,
+                           0xC0: 1, 0xD0: 1, 0xE0: 2}
+
 class TrackEvent:
 
     def __init__(self, time, curr_notes):
@@ -17,106 +40,209 @@ class TrackEvent:
             self.num_simultaneous_notes, self.curr_notes)
 
 
-class Note:
-
-    def __init__(self, note_number, start, end, velocity, instrument_name):
-        self.note_number = note_number
-        self.octave = note_number_to_octave(note_number)
-        self.tone = note_number_to_tone(note_number, self.octave)
-        self.start = start
-        self.end = end
-        self.duration = end - start
-        self.velocity = velocity
-        self.video_position = None
-        self.num_sim_notes = 0
-        self.instrument_name = instrument_name
-    
-    def get_num_sim_notes(self):
-        return self.num_sim_notes
-
-    def __repr__(self):
-        return "{}{} from {} to {} (duration: {})".format(self.tone, self.octave, 
-                                                          self.start, self.end, self.duration)
-
-
-def _event_pitch(event):
-    return event.data[0]
-
+# notes are stored in tables, numpy arrays of this type sorted by start time,
+# with the instrument given by its index in a separate list of names
+NOTE_DTYPE = np.dtype([
+    ('pitch', np.uint8),
+    ('start', np.int64),
+    ('end', np.int64),
+    ('velocity', np.uint8),
+    ('instrument', np.int16),
+    ('video_position', np.int16),
+    ('num_sim_notes', np.int16),
+])
 
-def _event_vel(event):
-    return event.data[1]
 
-
-def _is_note_start(event):
-    return isinstance(event, midi.NoteOnEvent) and _event_vel(event) != 0
+def make_note_table(pitches, starts, ends, velocities, instrument):
+    """
+    Creates a table of notes of one instrument, sorted by start time.
+    """
+    notes = np.zeros(len(pitches), dtype=NOTE_DTYPE)
+    notes['pitch'] = pitches
+    notes['start'] = starts
+    notes['end'] = ends
+    notes['velocity'] = velocities
+    notes['instrument'] = instrument
+    return notes[np.argsort(notes['start'], kind='mergesort')]
 
 
-def _is_note_end(event):
-    return isinstance(event, midi.NoteOffEvent) or \
-            (isinstance(event, midi.NoteOnEvent) and _event_vel(event) == 0)
+def merge_note_tables(notes1, notes2):
+    """
+    Returns a table of the notes of both tables, sorted by start time.
+    """
+    notes = np.concatenate((notes1, notes2))
+    return notes[np.argsort(notes['start'], kind='mergesort')]
 
 
-def has_notes(miditrack):
-    if not miditrack:
-        return False
-    for event in miditrack:
-        if isinstance(event, midi.NoteOnEvent):
-            return True
-    return False
-
+class MidiTrack:
+    """
+    The parts of a track of a midi file that are used: its name, tempo
+    and time signature changes and note events. The note events are kept as lists of ticks,
+    pitches and velocities, where a velocity of 0 means that a note ends.
+    """
 
-def get_total_num_ticks(midipattern):
-    max_ticks = 0
-    for track in filter(has_notes, midipattern):
-        max_ticks = max(max_ticks, track[-1].tick)
-    return max_ticks
+    def __init__(self):
+        self.name = None
+        self.num_events = 0
+        self.has_notes = False
+        # {tick: bpm}
+        self.tempo_changes = {}
+        # {tick: (numerator, denominator)}
+        self.time_signatures = {}
+        self.note_ticks = []
+        self.note_pitches = []
+        self.note_velocities = []
+
+    def get_instrument_name(self):
+        if self.name is not None:
+            return self.name
+        return "Untitled Instrument" + str(self.num_events)
+
+
+def _read_variable_length(data, pos):
+    value = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value = (value << 7) | (b & 0x7F)
+        if b < 0x80:
+            return value, pos
 
 
-def analyse_track(miditrack, total_num_ticks):
+def read_track(data, pos, end):
     """
-    Converts a miditrack to a list of Notes and a dictionary of events
+    Reads the events of the track chunk between pos and end in midi file
+    data, given as a bytearray, into a MidiTrack. Delta times are summed up
+    to absolute ticks, and a channel message without a status byte repeats
+    the status of the previous one (running status). Everything but the
+    notes, tempo and time signature changes and track name is skipped
+    without decoding it.
     """
-    curr_events = []
-    parsed_notes = []
-    max_simultaneous_notes = 0
-    max_velocity = 0
-    for event in miditrack:
-        if _is_note_start(event):
-            curr_events.append(event)
-        elif _is_note_end(event):
-            for i in range(len(curr_events)):
-                ev = curr_events[i]
-                p = _event_pitch(ev)
-                if _event_pitch(ev) == _event_pitch(event):
-                    vel = ev.get_velocity()
-                    note = Note(p, ev.tick, event.tick, vel,
-                                get_instrument_name(miditrack))
-                    max_velocity = max(vel, max_velocity)
-                    parsed_notes.append(note)
-                    curr_events.remove(ev)
-                    break
-    parsed_notes.sort(key=lambda n: n.start)
-    return parsed_notes, max_velocity#, split_points
-
-
-def assign_video_positions(parsed_notes):
+    track = MidiTrack()
+    note_ticks = track.note_ticks
+    note_pitches = track.note_pitches
+    note_velocities = track.note_velocities
+    num_events = 0
+    tick = 0
+    running_status = None
+    while pos < end:
+        if data[pos] < 0x80:
+            # most delta times fit in one byte
+            tick += data[pos]
+            pos += 1
+        else:
+            delta, pos = _read_variable_length(data, pos)
+            tick += delta
+        status = data[pos]
+        if status >= 0x80:
+            pos += 1
+        elif running_status is not None:
+            status = running_status
+        else:
+            raise ValueError("Midi event without status at byte {}".format(pos))
+        num_events += 1
+
+        if status == META_EVENT:
+            meta_type = data[pos]
+            length, pos = _read_variable_length(data, pos + 1)
+            if meta_type == META_SET_TEMPO:
+                mpqn = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+                track.tempo_changes[tick] = 6e7/mpqn
+            elif meta_type == META_TIME_SIGNATURE:
+                # the denominator is given as a power of two
+                track.time_signatures[tick] = (data[pos], 2**data[pos + 1])
+            elif meta_type == META_TRACK_NAME and track.name is None:
+                track.name = str(data[pos:pos + length])
+            pos += length
+        elif status in SYSEX_EVENTS:
+            length, pos = _read_variable_length(data, pos)
+            pos += length
+        else:
+            message = status & 0xF0
+            if message == NOTE_ON or message == NOTE_OFF:
+                if message == NOTE_ON:
+                    track.has_notes = True
+                    note_velocities.append(data[pos + 1])
+                else:
+                    note_velocities.append(0)
+                note_ticks.append(tick)
+                note_pitches.append(data[pos])
+                pos += 2
+            elif message in CHANNEL_MESSAGE_LENGTHS:
+                pos += CHANNEL_MESSAGE_LENGTHS[message]
+            else:
+                raise ValueError("Unknown midi event {:#x} at byte {}".format(
+                    status, pos))
+            running_status = status
+    track.num_events = num_events
+    return track
+
+
+def read_tracks(data):
     """
-    Assigns video positions and num_sim_notes to all notes.
+    Reads midi file data, a string or any other buffer, into its
+    resolution and list of MidiTracks.
     """
-    note_starts = {}
+    data = bytearray(data)
+    if data[:4] != b'MThd':
+        raise ValueError("Bad header in midi file")
+    header_length, _, _, resolution = struct.unpack('>LHHH', bytes(data[4:14]))
+    if resolution & 0x8000:
+        raise ValueError("SMPTE time division is not supported")
+
+    tracks = []
+    pos = 8 + header_length
+    while pos + 8 <= len(data):
+        chunk_type = bytes(data[pos:pos + 4])
+        length = struct.unpack('>L', bytes(data[pos + 4:pos + 8]))[0]
+        pos += 8
+        if chunk_type == b'MTrk':
+            tracks.append(read_track(data, pos, min(pos + length, len(data))))
+        pos += length
+    return resolution, tracks
+
+
+def analyse_track(track, instrument=0):
+    """
+    Converts a MidiTrack to a table of notes, with the given instrument
+    number. A note off ends the earliest started note of its pitch that
+    is still playing.
+    """
+    # {pitch: start ticks and velocities of the playing notes of that pitch}
+    open_notes = {}
+    pitches = []
+    starts = []
+    ends = []
+    velocities = []
+    for tick, pitch, velocity in zip(track.note_ticks, track.note_pitches,
+                                     track.note_velocities):
+        if velocity != 0:
+            if pitch not in open_notes:
+                open_notes[pitch] = deque()
+            open_notes[pitch].append((tick, velocity))
+        else:
+            started = open_notes.get(pitch)
+            if started:
+                start, start_velocity = started.popleft()
+                pitches.append(pitch)
+                starts.append(start)
+                ends.append(tick)
+                velocities.append(start_velocity)
+    return make_note_table(pitches, starts, ends, velocities, instrument)
 
-    for note in parsed_notes:
-        start = note.start
-        if not start in note_starts:
-            note_starts[start] = []
-        note_starts[start].append(note)
 
-    # for each of the notes in the list of parsed notes,
-    # fill their neighboring notes lists.
-    for time, notes in note_starts.items():
-        for i, n in enumerate(notes):
-            n.video_position = i
-            n.num_sim_notes = len(notes)
+def assign_video_positions(notes):
+    """
+    Assigns video positions and num_sim_notes to all notes of a table,
+    numbering the notes that start at the same time in table order.
+    """
+    if len(notes) == 0:
+        return
+    _, first_indices, counts = np.unique(notes['start'], return_index=True,
+                                         return_counts=True)
+    notes['video_position'] = (np.arange(len(notes)) -
+                               np.repeat(first_indices, counts))
+    notes['num_sim_notes'] = np.repeat(counts, counts)
 
 
 def _note_lists_equal(l1, l2):
@@ -186,64 +312,123 @@ def note_number_to_note_string(note_number):
     return tone + str(octave)
 
 
-def get_tempo(midipattern):
-    """Returns the tempo of the song in bpm"""
-    for p in midipattern[0]:
-        if isinstance(p, midi.SetTempoEvent):
-            return p.get_bpm()
+def note_string_to_note_number(note_string):
+    return TONES.index(note_string[:-1]) + int(note_string[-1])*len(TONES)
 
-    return DEFAULT_TEMPO
 
-
-def get_resolution(midipattern):
-    return midipattern.resolution
-
-
-def get_instruments(midipattern):
-    """
-    Gets the a dictionary of the used instruments (tracks) in a midi pattern,
-    mapped to the sorted list of unique note numbers that instrument plays.
-    """
-    result = {}
-    i = 0
-    for track in filter(has_notes, midipattern):
-        i += 1
-        name = get_instrument_name(track, i)
-        result[name] = _extract_notes(track)
-    return result
-
-
-def _extract_notes(miditrack):
+class TempoMap:
     """
-    Gets sorted list of all unique note numbers in a midi track.
+    Converts times in ticks to seconds in a song that changes tempo.
+    The tempo changes are given as sorted (tick, bpm) pairs. The first tempo
+    holds from the start of the song. The times are counted from offset
+    seconds into the song, so that parts of a song can start at 0.
     """
-    note_numbers = []
-    for event in miditrack:
-        if isinstance(event, midi.NoteOnEvent):
-            note_number, velocity = event.data
-            # velocity == 0 is equivalent to a note off event
-            if velocity != 0 and not note_number in note_numbers:
-                note_numbers.append(note_number)
-    return sorted(note_numbers)
-
 
-def get_instrument_name(miditrack, number=None):
+    def __init__(self, tempo_changes, resolution, offset=0.0):
+        if not tempo_changes:
+            tempo_changes = [(0, DEFAULT_TEMPO)]
+        self.tempo_changes = tempo_changes
+        self.resolution = resolution
+        self.offset = offset
+        self.ticks = np.array([0] + [t for t, _ in tempo_changes[1:]],
+                              dtype=np.float64)
+        self.pulse_lengths = np.array([60.0/(bpm*resolution)
+                                       for _, bpm in tempo_changes])
+        # the time in seconds at every tempo change
+        self.seconds = np.zeros(len(self.ticks))
+        self.seconds[1:] = np.cumsum(np.diff(self.ticks)*
+                                     self.pulse_lengths[:-1])
+        self.seconds -= offset
+
+    def to_seconds(self, ticks):
+        """
+        Converts a tick or an array of ticks to seconds.
+        """
+        ticks = np.asarray(ticks, dtype=np.float64)
+        i = np.searchsorted(self.ticks, ticks, side='right') - 1
+        i = np.maximum(i, 0)
+        return self.seconds[i] + (ticks - self.ticks[i])*self.pulse_lengths[i]
+
+    def shifted(self, offset):
+        """
+        Returns a TempoMap that counts times from offset seconds into the
+        song instead.
+        """
+        return TempoMap(self.tempo_changes, self.resolution,
+                        self.offset + offset)
+
+
+class Song:
     """
-    Gets the instrument name (track name) of the midi track.
+    Everything in a midi file that is needed to compose a video of it.
+    The tracks that play notes are given as note tables, where the
+    instrument numbers index instrument_names.
     """
-    for event in miditrack:
-        if isinstance(event, midi.TrackNameEvent):
-            return event.text
-    return "Untitled Instrument" + str(len(miditrack))
 
-
-def get_song_name(midipattern):
+    def __init__(self, name, resolution, tempo_changes, instrument_names,
+                 tracks, time_signatures=None):
+        self.name = name
+        self.resolution = resolution
+        self.tempo_changes = tempo_changes
+        self.instrument_names = instrument_names
+        self.tracks = tracks
+        # sorted (tick, (numerator, denominator)) pairs
+        self.time_signatures = time_signatures or []
+
+    def get_tempo_map(self):
+        return TempoMap(self.tempo_changes, self.resolution)
+
+    def bar_to_tick(self, bar):
+        """
+        Returns the tick where a bar starts, counting the bars from 1.
+        The song is in DEFAULT_TIME_SIGNATURE until its first time
+        signature change, and every change starts a new bar.
+        """
+        tick = 0
+        first_bar = 1
+        numerator, denominator = DEFAULT_TIME_SIGNATURE
+        for change_tick, signature in self.time_signatures:
+            ticks_per_bar = self.resolution*4.0*numerator/denominator
+            num_bars = int(math.ceil((change_tick - tick)/ticks_per_bar))
+            if first_bar + num_bars > bar:
+                break
+            first_bar += num_bars
+            tick = change_tick
+            numerator, denominator = signature
+        ticks_per_bar = self.resolution*4.0*numerator/denominator
+        return int(round(tick + (bar - first_bar)*ticks_per_bar))
+
+    def get_instruments(self):
+        """
+        Gets a dictionary of the instruments of the song, mapped to the
+        sorted list of unique note numbers that the instrument plays.
+        """
+        result = {}
+        for name, notes in zip(self.instrument_names, self.tracks):
+            result[name] = np.unique(notes['pitch']).tolist()
+        return result
+
+
+def read_song(midi_file_name):
     """
-    Gets the song name in the midi pattern.
-    Returns None if no name was found.
+    Reads and analyses a midi file.
     """
-    for p in midipattern[0]:
-        if isinstance(p, midi.TrackNameEvent):
-            return p.text
-    return None
-
+    with tracing.span('parse midi'):
+        with open(midi_file_name, 'rb') as f:
+            resolution, tracks = read_tracks(f.read())
+
+    # later tempo changes at the same tick override earlier ones
+    tempo_changes = {}
+    time_signatures = {}
+    for track in tracks:
+        tempo_changes.update(track.tempo_changes)
+        time_signatures.update(track.time_signatures)
+
+    song_name = tracks[0].name if tracks else None
+    note_tracks = [track for track in tracks if track.has_notes]
+    with tracing.span('analyse notes'):
+        note_tables = [analyse_track(track, i)
+                       for i, track in enumerate(note_tracks)]
+    return Song(song_name, resolution, sorted(tempo_changes.items()),
+                [track.get_instrument_name() for track in note_tracks],
+                note_tables, sorted(time_signatures.items()))
@@ -0,0 +1,48 @@
+import heapq
+
+
+class ActiveNoteIndex:
+    """
+    Sorted interval index over the start and end times of a list of notes.
+    Answers which notes are sounding at a given time by sweeping a line
+    forward, so that every query only touches the notes that start or stop
+    since the previous one.
+    """
+
+    def __init__(self, starts, ends):
+        self.starts = starts
+        self.ends = ends
+        self.order = sorted(range(len(starts)), key=lambda i: starts[i])
+        self.sorted_starts = [starts[i] for i in self.order]
+        self.reset()
+
+    def reset(self):
+        self.time = float('-inf')
+        self.next_start = 0
+        self.pending_ends = []
+        self.active = set()
+
+    def active_at(self, t):
+        """
+        Returns the sorted indices of the notes that satisfy start <= t < end.
+        Queries are expected in increasing time order, going back in time
+        restarts the sweep from the beginning.
+        """
+        if t < self.time:
+            self.reset()
+        self.time = t
+
+        num_notes = len(self.order)
+        while (self.next_start < num_notes and
+               self.sorted_starts[self.next_start] <= t):
+            i = self.order[self.next_start]
+            if self.ends[i] > t:
+                heapq.heappush(self.pending_ends, (self.ends[i], i))
+                self.active.add(i)
+            self.next_start += 1
+
+        while self.pending_ends and self.pending_ends[0][0] <= t:
+            _, i = heapq.heappop(self.pending_ends)
+            self.active.discard(i)
+
+        return sorted(self.active)
@@ -0,0 +1,85 @@
+import json
+import os
+
+import numpy as np
+import filecache
+import midiparse
+import tracing
+
+# bump this whenever the parsing changes, to invalidate cached songs
+SONG_CACHE_VERSION = 4
+
+# names in midi files are bytes in no particular encoding. They are stored
+# as the characters of these code points, which maps every byte to one
+NAME_ENCODING = 'latin-1'
+
+CACHE_EXTENSION = '.npz'
+
+# the cache is trimmed to this size after every insertion
+MAX_CACHE_SIZE = 256*1024**2
+
+
+def load_song(midi_file_name, cache_dir):
+    """
+    Returns the midiparse.Song of a midi file. The analysed song is stored
+    in cache_dir under the hash of the file, so that a file is only parsed
+    the first time it is used.
+    """
+    key = '{}-{}'.format(filecache.file_hash(midi_file_name),
+                         SONG_CACHE_VERSION)
+    file_name = os.path.join(cache_dir, key + CACHE_EXTENSION)
+    try:
+        song = _read_song(file_name)
+        filecache.touch(file_name)
+        tracing.count('song', True)
+        return song
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+
+    tracing.count('song', False)
+    song = midiparse.read_song(midi_file_name)
+    filecache.make_dir(cache_dir)
+    tmp_file_name = filecache.temporary_file_name(file_name)
+    _write_song(tmp_file_name, song)
+    filecache.publish(tmp_file_name, file_name)
+    filecache.evict(cache_dir, MAX_CACHE_SIZE, CACHE_EXTENSION)
+    return song
+
+
+def _decode_name(name):
+    if name is None:
+        return None
+    return name.decode(NAME_ENCODING)
+
+
+def _encode_name(name):
+    if name is None:
+        return None
+    return name.encode(NAME_ENCODING)
+
+
+def _write_song(file_name, song):
+    info = {
+        'name': _decode_name(song.name),
+        'resolution': song.resolution,
+        'tempo_changes': song.tempo_changes,
+        'time_signatures': song.time_signatures,
+        'instrument_names': [_decode_name(name)
+                             for name in song.instrument_names],
+    }
+    tracks = {'track{}'.format(i): notes for i, notes in enumerate(song.tracks)}
+    with open(file_name, 'wb') as f:
+        np.savez(f, info=np.array(json.dumps(info)), **tracks)
+
+
+def _read_song(file_name):
+    with np.load(file_name) as cached:
+        info = json.loads(str(cached['info']))
+        tracks = [cached['track{}'.format(i)]
+                  for i in range(len(info['instrument_names']))]
+    return midiparse.Song(_encode_name(info['name']), info['resolution'],
+                          [tuple(change) for change in info['tempo_changes']],
+                          [_encode_name(name)
+                           for name in info['instrument_names']], tracks,
+                          [(tick, tuple(signature))
+                           for tick, signature in info['time_signatures']])
@@ -1,8 +1,64 @@
 import unittest
+import os
+import shutil
+import struct
+import tempfile
 from midiparse import *
+from noteindex import ActiveNoteIndex
+import audioanalysis
+import audiomixing
+import cliplibrary
+import compilelibrary
+import framecache
+import main
+import songcache
+import tracing
+import videocomposing
+import numpy as np
+import scipy.signal as signal
 
 class MidiparseTests(unittest.TestCase):
-    pass
+
+    def test_tempo_map(self):
+        tempo_map = TempoMap([(0, 120), (480, 60)], 480)
+        self.assertEqual(list(tempo_map.to_seconds([0, 240, 480, 960, 1440])),
+                         [0, 0.25, 0.5, 1.5, 2.5])
+        self.assertEqual(TempoMap([], 480).to_seconds(480),
+                         60.0/DEFAULT_TEMPO)
+        self.assertEqual(list(tempo_map.shifted(1.5).to_seconds([0, 960])),
+                         [-1.5, 0])
+
+    def test_assign_video_positions(self):
+        notes = make_note_table([60, 64, 67, 60], [0, 0, 0, 10],
+                                [10, 10, 10, 20], [100]*4, 0)
+        assign_video_positions(notes)
+        self.assertEqual(list(notes['video_position']), [0, 1, 2, 0])
+        self.assertEqual(list(notes['num_sim_notes']), [3, 3, 3, 1])
+
+    def test_read_tracks(self):
+        events = (b'\x00\xff\x03\x04Lead'
+                  b'\x00\xff\x51\x03\x07\xa1\x20'
+                  # 6/8
+                  b'\x00\xff\x58\x04\x06\x03\x18\x08'
+                  b'\x00\x90\x3c\x40'
+                  # running status
+                  b'\x00\x40\x50'
+                  b'\x60\x3c\x00'
+                  b'\x00\xb0\x07\x64'
+                  # two byte delta time
+                  b'\x81\x40\x80\x40\x00'
+                  b'\x00\xff\x2f\x00')
+        data = (b'MThd' + struct.pack('>LHHH', 6, 1, 1, 96) +
+                b'MTrk' + struct.pack('>L', len(events)) + events)
+        resolution, tracks = read_tracks(data)
+        self.assertEqual(resolution, 96)
+        self.assertEqual(len(tracks), 1)
+        self.assertEqual(tracks[0].name, 'Lead')
+        self.assertEqual(tracks[0].tempo_changes, {0: 120.0})
+        self.assertEqual(tracks[0].time_signatures, {0: (6, 8)})
+        notes = analyse_track(tracks[0])
+        self.assertEqual(notes[['pitch', 'start', 'end', 'velocity']].tolist(),
+                         [(60, 0, 96, 64), (64, 0, 288, 80)])
 
     # def test_find_intervals_of_silence(self):
     #     test_seq1 = [Note(0, 0, 10, 0), 
@@ -38,3 +94,362 @@ class MidiparseTests(unittest.TestCase):
     #     self.assertListEqual(res_non_silent2, exp_non_silent2)
     #     self.assertListEqual(res_non_silent3, exp_non_silent3)
 
+
+
+class MainTests(unittest.TestCase):
+
+    def test_parse_time(self):
+        # a beat is 480 ticks and half a second
+        song = Song(None, 480, [(0, 120)], [], [])
+        self.assertEqual(main.parse_time('12.5', song), 12.5)
+        self.assertEqual(main.parse_time('1b', song), 0)
+        self.assertEqual(main.parse_time('3b', song), 4.0)
+        # two bars of 3/4, then 2/4 from the third bar
+        song.time_signatures = [(0, (3, 4)), (2880, (2, 4))]
+        self.assertEqual(main.parse_time('2b', song), 1.5)
+        self.assertEqual(main.parse_time('3b', song), 3.0)
+        self.assertEqual(main.parse_time('5b', song), 5.0)
+        # a change in the middle of a bar starts a new one
+        song.time_signatures = [(0, (3, 4)), (2000, (2, 4))]
+        self.assertEqual(main.parse_time('3b', song), 2000/960.0)
+        self.assertRaises(ValueError, main.parse_time, '0b', song)
+
+
+class NoteIndexTests(unittest.TestCase):
+
+    def test_active_at(self):
+        index = ActiveNoteIndex([0, 1, 1, 5], [2, 3, 1, 6])
+
+        self.assertListEqual(index.active_at(0), [0])
+        self.assertListEqual(index.active_at(1), [0, 1])
+        self.assertListEqual(index.active_at(2.5), [1])
+        self.assertListEqual(index.active_at(4), [])
+        self.assertListEqual(index.active_at(5), [3])
+        # going back in time restarts the sweep
+        self.assertListEqual(index.active_at(1.5), [0, 1])
+
+
+class AudioanalysisTests(unittest.TestCase):
+
+    def test_moving_average(self):
+        samples = np.random.RandomState(0).rand(20000)
+        for kernel_size in [1, 4, 7, 7000, 30000]:
+            kernel = np.ones((kernel_size,))/kernel_size
+            expected = signal.convolve(samples, kernel, mode='same')
+            result = audioanalysis._moving_average(samples, kernel_size)
+            self.assertTrue(np.allclose(result, expected))
+
+    def test_find_sounds(self):
+        start = audioanalysis.START_THRESHOLD*1.5
+        end = audioanalysis.END_THRESHOLD*1.5
+        quiet = audioanalysis.END_THRESHOLD*0.5
+        filtered = np.array([quiet, end, start, end, quiet,
+                             end, quiet, start, start])
+        self.assertListEqual(audioanalysis._find_sounds(filtered),
+                             [(2, 3), (7, 8)])
+
+
+class AudiomixingTests(unittest.TestCase):
+
+    def test_mix(self):
+        sound = np.ones((10, 2), dtype=np.float32)
+        mixed = audiomixing.mix([(sound, 0.0, 1.0, 0.5),
+                                 (sound, 0.4, 0.3, 2.0),
+                                 (sound, 0.8, 1.0, 1.0)],
+                                1.0, sample_rate=10)
+        self.assertEqual(mixed.shape, (10, 2))
+        self.assertEqual(list(mixed[:, 0]),
+                         [0.5]*4 + [2.5]*3 + [0.5] + [1.5]*2)
+        # sounds that started before the buffer are cut off at its start
+        mixed = audiomixing.mix([(np.arange(10.0)[:, None]*sound, -0.3,
+                                  0.5, 1.0)], 1.0, sample_rate=10)
+        self.assertEqual(list(mixed[:, 0]), [3, 4] + [0]*8)
+
+
+def _fake_parse_infos(file_name):
+    return {'duration': 2.0, 'video_fps': 30.0, 'video_size': [64, 48],
+            'audio_found': True}
+
+
+class CliplibraryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.parse_infos = cliplibrary.ffmpeg_parse_infos
+        cliplibrary.ffmpeg_parse_infos = _fake_parse_infos
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        cliplibrary.ffmpeg_parse_infos = self.parse_infos
+        shutil.rmtree(self.dir)
+
+    def test_store_analysis(self):
+        file_names = [os.path.join(self.dir, name)
+                      for name in ['C4.mp4', 'D4.mp4', 'E4.mp4']]
+        for file_name, contents in zip(file_names, ['a', 'a', 'b']):
+            with open(file_name, 'w') as f:
+                f.write(contents)
+        library_file_name = os.path.join(self.dir, 'library.sqlite')
+        library = cliplibrary.ClipLibrary(library_file_name)
+
+        clip = library.get_clip(file_names[0])
+        self.assertFalse(clip.is_analysed())
+        self.assertEqual((clip.duration, clip.width, clip.height,
+                          clip.has_audio), (2.0, 64, 48, True))
+        library.store_analysis(clip, 0.25, 0.5, [0.1, 0.2])
+
+        clip = cliplibrary.ClipLibrary(library_file_name).get_clip(
+            file_names[0])
+        self.assertEqual((clip.offset, clip.max_vol), (0.25, 0.5))
+        self.assertTrue(np.allclose(clip.envelope, [0.1, 0.2]))
+        # a copy of the clip is the same recording, which is
+        # already analysed
+        copy = library.get_clip(file_names[1])
+        self.assertEqual(copy.hash, clip.hash)
+        self.assertEqual(copy.offset, 0.25)
+        other = library.get_clip(file_names[2])
+        self.assertNotEqual(other.hash, clip.hash)
+        self.assertFalse(other.is_analysed())
+        connection = library._connect()
+        self.assertEqual(connection.execute(
+            'SELECT COUNT(*) FROM clips').fetchone()[0], 2)
+
+
+class CompilelibraryTests(unittest.TestCase):
+
+    def test_find_instrument_dirs(self):
+        source_dir = tempfile.mkdtemp()
+        try:
+            for name in ['Bass', 'Piano']:
+                os.mkdir(os.path.join(source_dir, name))
+            open(os.path.join(source_dir, 'notes.txt'), 'w').close()
+            self.assertEqual(
+                compilelibrary._find_instrument_dirs(source_dir, None),
+                {os.path.join(source_dir, 'Bass'): 'Bass',
+                 os.path.join(source_dir, 'Piano'): 'Piano'})
+        finally:
+            shutil.rmtree(source_dir)
+
+        config = {'Piano': 'a/piano', 'Keys': 'a/piano/',
+                  'Bass': 'b/../b/bass'}
+        self.assertEqual(compilelibrary._find_instrument_dirs(None, config),
+                         {'a/piano': 'piano', 'b/bass': 'bass'})
+        config['Grand piano'] = 'b/piano'
+        self.assertRaises(ValueError, compilelibrary._find_instrument_dirs,
+                          None, config)
+
+
+class _FakeVideoReader:
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.closed = False
+
+    def get_frame(self, t):
+        return np.full((4, 6, 3), int(round(t*10)), dtype=np.uint8)
+
+    def close(self):
+        self.closed = True
+
+
+class FramecacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.video_reader = framecache.FFMPEG_VideoReader
+        self.max_open_readers = framecache.MAX_OPEN_READERS
+        framecache.FFMPEG_VideoReader = _FakeVideoReader
+        # start with an empty pool
+        framecache.set_max_open_readers(0)
+        framecache.set_max_open_readers(2)
+
+    def tearDown(self):
+        framecache.FFMPEG_VideoReader = self.video_reader
+        framecache.set_max_open_readers(self.max_open_readers)
+
+    def test_reader_pool(self):
+        a = framecache._get_reader('a.mp4')
+        b = framecache._get_reader('b.mp4')
+        self.assertTrue(framecache._get_reader('a.mp4') is a)
+        # b is now the least recently used reader
+        c = framecache._get_reader('c.mp4')
+        self.assertTrue(b.closed)
+        self.assertFalse(a.closed or c.closed)
+        self.assertEqual(list(framecache._open_readers), ['a.mp4', 'c.mp4'])
+        framecache.set_max_open_readers(1)
+        self.assertTrue(a.closed)
+        self.assertEqual(list(framecache._open_readers), ['c.mp4'])
+        # a forked process opens its own readers, and leaves the ones
+        # of its parent open
+        framecache._readers_pid = None
+        new_c = framecache._get_reader('c.mp4')
+        self.assertFalse(new_c is c)
+        self.assertFalse(c.closed)
+        framecache.close_readers()
+        self.assertTrue(new_c.closed)
+        self.assertEqual(len(framecache._open_readers), 0)
+
+    def test_cache_frames(self):
+        clip = cliplibrary.ClipInfo('C4.mp4', 'abc', 2.0, 10, 6, 4, False,
+                                    0.5, 0.5, None)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            framecache.cache_frames(cache_dir, clip, [(3, 2), (6, 4)], 10, 3,
+                                    framecache.RESIZE_NEAREST)
+            self.assertEqual(len(framecache._open_readers), 1)
+            for size in [(3, 2), (6, 4)]:
+                self.assertTrue(framecache.is_cached(
+                    cache_dir, clip, size, 10, 3, framecache.RESIZE_NEAREST))
+            frames = np.load(framecache._entry_file_name(
+                cache_dir, clip, (3, 2), 10, framecache.RESIZE_NEAREST))
+            self.assertEqual(frames.shape, (3, 2, 3, 3))
+            # the frames from the offset on
+            self.assertEqual(frames[:, 0, 0, 0].tolist(), [5, 6, 7])
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class SongcacheTests(unittest.TestCase):
+
+    def test_write_and_read_song(self):
+        notes = make_note_table([60], [0], [480], [100], 0)
+        # a latin-1 name, which isn't valid utf-8
+        song = Song('Song', 480, [(0, 120)], ['Cl\xe9', 'Piano'],
+                    [notes, notes], [(0, (3, 4))])
+        cache_dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(cache_dir, 'song.npz')
+            songcache._write_song(file_name, song)
+            cached = songcache._read_song(file_name)
+        finally:
+            shutil.rmtree(cache_dir)
+        self.assertEqual(cached.name, 'Song')
+        self.assertEqual(cached.instrument_names, ['Cl\xe9', 'Piano'])
+        self.assertTrue(all(type(name) is str
+                            for name in cached.instrument_names))
+        self.assertEqual(cached.tracks[1].tolist(), notes.tolist())
+        self.assertEqual(cached.time_signatures, [(0, (3, 4))])
+
+
+class TracingTests(unittest.TestCase):
+
+    def setUp(self):
+        tracing.enable()
+
+    def tearDown(self):
+        tracing.disable()
+
+    def test_take_and_merge(self):
+        with tracing.span('work', frames=3) as args:
+            args['fps'] = 30
+        tracing.count('frame', True)
+        tracing.count('frame', False)
+        events, counts, _, _ = data = tracing.take()
+        self.assertEqual([e['name'] for e in events], ['work'])
+        self.assertEqual(events[0]['args'], {'frames': 3, 'fps': 30})
+        self.assertEqual(counts, {'frame': [1, 1]})
+        # taking again only returns what was recorded since
+        self.assertEqual(tracing.take()[:2], ([], {}))
+        tracing.merge(data)
+        tracing.merge(data)
+        self.assertEqual(tracing.take()[1], {'frame': [2, 2]})
+
+
+class VideocomposingTests(unittest.TestCase):
+
+    def test_overlap_matrix(self):
+        track1 = make_note_table([60, 62], [0, 10], [10, 20], [100, 100], 0)
+        track2 = make_note_table([60, 60], [2, 10], [4, 12], [100, 100], 1)
+        track3 = make_note_table([60], [20], [30], [100], 2)
+        overlaps = videocomposing._overlap_matrix([track1, track2, track3])
+        self.assertEqual(overlaps[0, 1], 2)
+        self.assertEqual(overlaps[1, 0], 2)
+        self.assertEqual(overlaps[0, 2], 0)
+        self.assertEqual(overlaps[1, 2], 0)
+
+    def test_merge_analysed_tracks(self):
+        num_tracks = videocomposing.MAX_NUM_SIM_TRACKS + 1
+        # every track overlaps all others, except the first two
+        tracks = {(str(i),): (make_note_table([60], [0], [10], [100], i), 100)
+                  for i in range(2, num_tracks)}
+        tracks[('0',)] = (make_note_table([60], [0], [5], [100], 0), 100)
+        tracks[('1',)] = (make_note_table([60], [5], [10], [100], 1), 100)
+        videocomposing._merge_analysed_tracks(tracks)
+        self.assertEqual(len(tracks), videocomposing.MAX_NUM_SIM_TRACKS)
+        self.assertTrue(('0', '1') in tracks or ('1', '0') in tracks)
+
+    def test_track_cache_key(self):
+        clip = cliplibrary.ClipInfo('C4.mp4', 'abc', 2.0, 30, 64, 48, True,
+                                    0.1, 0.5, None)
+        clips = {'Piano': ({60: clip}, 0.5)}
+        notes = make_note_table([60], [0], [480], [100], 0)
+        tempo_map = TempoMap([(0, 120)], 480)
+        key = videocomposing._track_cache_key(notes, ['Piano'], clips,
+                                              tempo_map, (32, 24), 4.0, 30,
+                                              'smooth')
+        # a longer range of the same notes is a longer video
+        self.assertNotEqual(videocomposing._track_cache_key(
+            notes, ['Piano'], clips, tempo_map, (32, 24), 6.0, 30, 'smooth'),
+            key)
+        self.assertNotEqual(videocomposing._track_cache_key(
+            notes, ['Piano'], clips, tempo_map, (32, 24), 4.0, 15, 'nearest'),
+            key)
+
+    def test_get_common_split_points(self):
+        track1 = make_note_table([60, 62], [0, 20], [10, 30], [100]*2, 0)
+        track2 = make_note_table([60, 64], [5, 40], [15, 50], [100]*2, 1)
+        # a note that never sounds, while track1 plays
+        track3 = make_note_table([60], [5], [5], [100], 2)
+        tracks = [(track1, 100), (track2, 100), (track3, 100)]
+        self.assertEqual(videocomposing._get_common_split_points(tracks, 1),
+                         [15, 30, 50])
+        # the split points are at least MIN_NUM_MEASURES_BEFORE_SPLIT
+        # measures apart, here 16 and 40 ticks
+        self.assertEqual(videocomposing._get_common_split_points(tracks, 2),
+                         [15, 50])
+        self.assertEqual(videocomposing._get_common_split_points(tracks, 5),
+                         [15])
+
+    def test_plan_segments(self):
+        tempo_map = TempoMap([(0, 120)], 480)
+        max_frames = int(videocomposing.MAX_SEGMENT_DURATION*30)
+        segments = videocomposing._plan_segments([], tempo_map, 1830, 30)
+        self.assertEqual(segments[0], (0, max_frames))
+        self.assertEqual(segments[-1][1], 1830)
+        # a longer track keeps all of its earlier segments
+        longer = videocomposing._plan_segments([], tempo_map, 1845, 30)
+        self.assertEqual(longer[:-1], segments[:-1])
+        # split points at 0.5 and 5 seconds, and pieces cut from them
+        segments = videocomposing._plan_segments([480, 4800], tempo_map,
+                                                 900, 30)
+        self.assertEqual(segments, [(0, 15), (15, 150), (150, 450),
+                                    (450, 750), (750, 900)])
+
+    def test_segment_cache_key(self):
+        clip = cliplibrary.ClipInfo('C4.mp4', 'abc', 2.0, 30, 64, 48, True,
+                                    0.1, 0.5, None)
+        clips = {'Piano': ({60: clip, 62: clip}, 0.5)}
+        placements = [(('Piano', 60, (32, 24)), 0.0, 1.0, (0, 0)),
+                      (('Piano', 62, (32, 24)), 1.0, 2.0, (0, 0))]
+        key = videocomposing._segment_cache_key(clips, placements, (0, 60),
+                                                (32, 24), 30, 'smooth')
+        # the same recording played at the same times looks the same
+        other_placements = [(('Piano', 62, (32, 24)), 0.0, 1.0, (0, 0)),
+                            placements[1]]
+        self.assertEqual(videocomposing._segment_cache_key(
+            clips, other_placements, (0, 60), (32, 24), 30, 'smooth'), key)
+        moved_placements = [placements[0],
+                            (('Piano', 62, (32, 24)), 1.5, 2.0, (0, 0))]
+        self.assertNotEqual(videocomposing._segment_cache_key(
+            clips, moved_placements, (0, 60), (32, 24), 30, 'smooth'), key)
+
+    def test_frame_buffers(self):
+        buffers = videocomposing._FrameBuffers((4, 2), 2)
+        picture = np.full((2, 2, 3), 255, dtype=np.uint8)
+        first = buffers.draw([(picture, 0, 0), (picture, 2, 0)])
+        second = buffers.draw([])
+        self.assertEqual(first.min(), 255)
+        self.assertEqual(second.max(), 0)
+        # the first buffer again, where only the right tile is drawn over
+        frame = buffers.draw([(picture[:, :1] // 2, 2, 0)])
+        self.assertTrue(frame is first)
+        self.assertEqual(frame[:, :, 0].tolist(), [[0, 0, 127, 0],
+                                                   [0, 0, 127, 0]])
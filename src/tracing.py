@@ -0,0 +1,208 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+# whether anything is recorded, set with enable() before
+# any worker processes are started
+_enabled = False
+
+# the process that the recorded data belongs to; forked processes
+# inherit the data of their parent, which is dropped on first use
+_pid = None
+
+# spans of this process, as events of the Chrome trace format
+_events = []
+
+# {cache name: [hits, misses]}
+_cache_counts = {}
+
+# {pid: name} of all processes, and {pid: peak RSS in bytes}
+_process_names = {}
+_peak_rss = {}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+    set_process_name('main')
+
+
+def disable():
+    """
+    Stops recording and drops everything recorded so far.
+    """
+    global _enabled, _pid
+    _enabled = False
+    # the data is dropped when it's next used
+    _pid = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def _own_data():
+    global _pid, _events, _cache_counts, _process_names, _peak_rss
+    pid = os.getpid()
+    if _pid != pid:
+        _pid = pid
+        _events = []
+        _cache_counts = {}
+        _process_names = {}
+        _peak_rss = {}
+    return pid
+
+
+def set_process_name(name):
+    if _enabled:
+        _process_names[_own_data()] = name
+
+
+@contextmanager
+def span(name, **args):
+    """
+    Records the time spent in the body of the with statement as a span
+    named name, with the given arguments. The arguments are yielded as a
+    dictionary, so that results like frame rates can be added to them.
+    """
+    if not _enabled:
+        yield args
+        return
+    pid = _own_data()
+    start = time.time()
+    try:
+        yield args
+    finally:
+        _events.append({
+            'name': name,
+            'ph': 'X',
+            'pid': pid,
+            'tid': pid,
+            'ts': start*1e6,
+            'dur': (time.time() - start)*1e6,
+            'args': args,
+        })
+
+
+def count(cache_name, hit):
+    """
+    Counts a lookup in the cache with the given name.
+    """
+    if _enabled:
+        _own_data()
+        counts = _cache_counts.setdefault(cache_name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+
+def _record_peak_rss():
+    pid = _own_data()
+    _peak_rss[pid] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def take():
+    """
+    Returns everything recorded in this process since the last call,
+    to be passed to merge in the main process.
+    """
+    _record_peak_rss()
+    data = (_events[:], dict(_cache_counts), dict(_process_names),
+            dict(_peak_rss))
+    del _events[:]
+    _cache_counts.clear()
+    return data
+
+
+def merge(data):
+    """
+    Adds what another process recorded to the data of this process.
+    """
+    events, cache_counts, process_names, peak_rss = data
+    _own_data()
+    _events.extend(events)
+    for cache_name, (hits, misses) in cache_counts.items():
+        counts = _cache_counts.setdefault(cache_name, [0, 0])
+        counts[0] += hits
+        counts[1] += misses
+    _process_names.update(process_names)
+    for pid, rss in peak_rss.items():
+        _peak_rss[pid] = max(rss, _peak_rss.get(pid, 0))
+
+
+def _call_traced(args):
+    function, item = args
+    set_process_name('pool worker')
+    with span(function.__name__):
+        result = function(item)
+    return result, take()
+
+
+def pool_map(pool, function, items):
+    """
+    Like pool.map, but records a span for every call in the workers
+    and merges them into the data of this process.
+    """
+    if not _enabled:
+        return pool.map(function, items)
+    results = pool.map(_call_traced, [(function, item) for item in items])
+    for _, data in results:
+        merge(data)
+    return [result for result, _ in results]
+
+
+def write_trace(file_name):
+    """
+    Writes everything recorded as a Chrome trace file, which can
+    be opened in chrome://tracing or the Perfetto UI.
+    """
+    _record_peak_rss()
+    events = list(_events)
+    for pid, name in _process_names.items():
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'tid': pid, 'args': {'name': name}})
+    end = max([e['ts'] + e['dur'] for e in _events] or [0])
+    for pid, rss in _peak_rss.items():
+        events.append({'name': 'peak RSS', 'ph': 'C', 'pid': pid,
+                       'tid': pid, 'ts': end,
+                       'args': {'MiB': rss/1024.0**2}})
+    with open(file_name, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def print_summary():
+    """
+    Prints the total time of every kind of span, the frame rate of the
+    rendering, the hit rates of the caches and the peak memory use.
+    """
+    _record_peak_rss()
+    # {name: [number of spans, total seconds, longest seconds]}
+    totals = {}
+    for event in _events:
+        seconds = event['dur']/1e6
+        total = totals.setdefault(event['name'], [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += seconds
+        total[2] = max(total[2], seconds)
+
+    print("\n{:<24}{:>8}{:>12}{:>12}".format('Span', 'Count', 'Total (s)',
+                                              'Max (s)'))
+    for name, (num, seconds, longest) in sorted(totals.items(),
+                                                key=lambda t: -t[1][1]):
+        print("{:<24}{:>8}{:>12.3f}{:>12.3f}".format(name, num, seconds,
+                                                     longest))
+
+    frames = [(e['args']['frames'], e['dur']/1e6) for e in _events
+              if 'frames' in e['args']]
+    if frames:
+        num_frames = sum(f for f, _ in frames)
+        seconds = sum(s for _, s in frames)
+        print("\nRendered {} frames at {:.1f} frames per second "
+              "per worker".format(num_frames, num_frames/max(seconds, 1e-9)))
+
+    for cache_name, (hits, misses) in sorted(_cache_counts.items()):
+        print("{} cache: {} of {} hit ({:.0%})".format(
+            cache_name, hits, hits + misses, float(hits)/(hits + misses)))
+
+    peak_rss = max(_peak_rss.values() or [0])
+    print("Peak RSS: {:.0f} MiB".format(peak_rss/1024.0**2))
@@ -1,17 +1,32 @@
 import multiprocessing
 import moviepy.editor as edit
-import moviepy.video.fx.all as fx
+import numpy as np
 import pdb
 import midiparse
+import noteindex
+import framecache
+import cliplibrary
+import filecache
+import tracing
+import videowriter
 import random
 import os
+import shutil
 import audioanalysis
+import audiomixing
 import math
-import json
 import time
+import json
+import hashlib
 import progress.bar as bar
 import sys
 import traceback
+import subprocess as sp
+from moviepy.config import get_setting
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
 
 # Message: (1, 0)
 MSG_PROCESSED_SEGMENT = 1
@@ -19,107 +34,349 @@ MSG_PROCESSED_SEGMENT = 1
 # Message: (2, Exception)
 MSG_FATAL_ERROR = 2
 
-# Message: (3, num processed segments)
+# Message: (3, name of the written file)
 MSG_DONE = 3
 
+# message with the tracing data of a job, sent before MSG_DONE
+MSG_TRACE = 4
+
 SUPPORTED_EXTENSIONS = ['mp4']
 WORKING_DIR_NAME = 'temp'
 OFFSET_FILE_NAME = 'offset.json'
 
+FPS = 30
+
+# the filter that note clips are resized to their tiles with
+RESIZE_FILTER = framecache.RESIZE_SMOOTH
+
+# drafts are rendered faster at a lower quality, for previews: at a lower
+# frame rate, and with the note clips resized by picking the nearest pixels
+DRAFT_FPS = 15
+DRAFT_RESIZE_FILTER = framecache.RESIZE_NEAREST
+
+# rendered tracks are stored with a lossless intra-only codec, so that
+# they can be composited without generation loss or costly decoding,
+# and so that segments of them can be joined without encoding them again
+INTERMEDIATE_CODEC = 'ffv1'
+INTERMEDIATE_EXTENSION = 'mkv'
+
+# tracks are split into segments of at most this many seconds,
+# which are rendered in parallel
+MAX_SEGMENT_DURATION = 10.0
+
+FRAME_CACHE_DIR = os.path.join(WORKING_DIR_NAME, 'frames')
+
+# rendered tracks are stored under a hash of everything that went into
+# rendering them, and the least recently used ones are removed
+# when the cache grows larger than this
+TRACK_CACHE_DIR = os.path.join(WORKING_DIR_NAME, 'tracks')
+MAX_TRACK_CACHE_SIZE = 20*1024**3
+
+# the segments that tracks are joined from are kept as well, stored under
+# a hash of the notes they show, so that when a song is edited only the
+# segments with changed notes are rendered again
+SEGMENT_CACHE_DIR = os.path.join(WORKING_DIR_NAME, 'segments')
+MAX_SEGMENT_CACHE_SIZE = 20*1024**3
+
+# bump this whenever the rendering changes, to invalidate cached tracks
+# and segments
+TRACK_CACHE_VERSION = 4
+
 MIN_NUM_MEASURES_BEFORE_SPLIT = 2
 
 MAX_NUM_SIM_TRACKS = 9
 
+# seconds between checks for crashed processes while waiting for jobs
+CRASH_CHECK_INTERVAL = 1.0
+
+# the audio of all tracks, mixed separately from the video
+AUDIO_FILE_NAME = os.path.join(WORKING_DIR_NAME, 'audio.wav')
+
+# analysed midi files, by the hash of the file
+SONG_CACHE_DIR = os.path.join(WORKING_DIR_NAME, 'songs')
+
+# index of the probed metadata and analysed offsets of all note clips
+LIBRARY_FILE_NAME = os.path.join(WORKING_DIR_NAME, 'library.sqlite')
 
-def compose(instruments, midipattern, width, 
+
+def compose(song, width, 
             height, source_dir, volume_file_name,
-            num_threads, instrument_config_file):
+            num_threads, instrument_config_file, time_range=None,
+            draft=False):
+    """
+    Composes the video of a song. If time_range = (start, end) is given,
+    in seconds with end None for the end of the song, only the notes that
+    sound during it are rendered, into a video that starts at start.
+    If draft is given, the video is rendered with DRAFT_FPS and
+    DRAFT_RESIZE_FILTER.
+    """
+    fps = DRAFT_FPS if draft else FPS
+    resize_filter = DRAFT_RESIZE_FILTER if draft else RESIZE_FILTER
     _create_working_dir()
     volumes = _try_load_json_file(volume_file_name)
     instrument_config = _try_load_json_file(instrument_config_file)
-    tempo = midiparse.get_tempo(midipattern)
-    resolution = midiparse.get_resolution(midipattern)
-    pulse_length = 60.0/(tempo*resolution)
+    library = cliplibrary.ClipLibrary(LIBRARY_FILE_NAME)
+    resolution = song.resolution
+    tempo_map = song.get_tempo_map()
+    instrument_names = song.instrument_names
+
+    # analysed_tracks :: {(name1, name2, ...): (notes, max_velocity)},
+    # where notes is a note table whose instrument numbers
+    # index instrument_names
+    with tracing.span('analyse tracks'):
+        analysed_tracks = _analyse_all_tracks(song)
+
+    duration = None
+    if time_range is not None:
+        tempo_map, duration = _cut_to_time_range(analysed_tracks, tempo_map,
+                                                 time_range)
+
+    # all_instrument_clips :: {name: ({note number: ClipInfo}, min_vol)}
+    with tracing.span('load clips'):
+        all_instrument_clips = _load_instrument_clips(song.get_instruments(),
+                                                      source_dir,
+                                                      instrument_config,
+                                                      library)
+
+    # the tracks with the most notes get the first tiles of the grid, and
+    # every track is rendered at the size of its tile
+    sorted_tracks = sorted(analysed_tracks.items(),
+                           key=lambda k: len(k[1][0]), reverse=True)
+    total_num_tracks = len(sorted_tracks)
+    split_points = _get_common_split_points(analysed_tracks.values(),
+                                            resolution)
+    filecache.make_dir(TRACK_CACHE_DIR)
+    filecache.make_dir(SEGMENT_CACHE_DIR)
+
+    track_tiles = []
+    jobs = []
+    # {rendered file name: file names of its segments}
+    track_segment_files = {}
+    # {segment file name: temporary file name it's rendered to}
+    rendered_segments = {}
+    # {(clip hash, offset, size): (clip, size, number of frames)}
+    needed_frames = {}
+    for i, (track_names, (notes, _)) in enumerate(sorted_tracks):
+        tile = _partition(width, height, total_num_tracks, i)
+        _, _, w, h = tile
+        instrument_clips = {name: all_instrument_clips[name]
+                            for name in track_names}
+        key = _track_cache_key(notes, instrument_names, instrument_clips,
+                               tempo_map, (w, h), duration, fps,
+                               resize_filter)
+        file_name = os.path.join(TRACK_CACHE_DIR,
+                                 key + '.' + INTERMEDIATE_EXTENSION)
+        track_tiles.append((file_name, tile))
+        display_name = ', '.join(track_names)
+
+        is_cached = os.path.isfile(file_name)
+        tracing.count('track', is_cached)
+        if is_cached:
+            filecache.touch(file_name)
+        else:
+            placements, track_needed_frames = _place_notes(
+                notes, instrument_names, instrument_clips, tempo_map, (w, h),
+                fps)
+
+            if duration is not None:
+                num_frames = int(math.ceil(duration*fps))
+            else:
+                num_frames = int(math.ceil(max(p[2] for p in placements)*fps))
+            segments = _plan_segments(split_points, tempo_map, num_frames,
+                                      fps)
+            segment_files = []
+            for j, frame_range in enumerate(segments):
+                segment_placements = _placements_in_range(placements,
+                                                          frame_range, fps)
+                segment_file_name = os.path.join(
+                    SEGMENT_CACHE_DIR, '{}.{}'.format(
+                        _segment_cache_key(instrument_clips,
+                                           segment_placements, frame_range,
+                                           (w, h), fps, resize_filter),
+                        INTERMEDIATE_EXTENSION))
+                segment_files.append(segment_file_name)
+                # segments with the same notes are only rendered once
+                is_cached = (os.path.isfile(segment_file_name) or
+                             segment_file_name in rendered_segments)
+                tracing.count('segment', is_cached)
+                if is_cached:
+                    if segment_file_name not in rendered_segments:
+                        filecache.touch(segment_file_name)
+                    continue
+
+                tmp_file_name = filecache.temporary_file_name(
+                    segment_file_name)
+                rendered_segments[segment_file_name] = tmp_file_name
+                segment_needed_frames = {p[0]: track_needed_frames[p[0]]
+                                         for p in segment_placements}
+                for frames_key, num_frames in segment_needed_frames.items():
+                    name, note_number, size = frames_key
+                    c = instrument_clips[name][0][note_number]
+                    clip_key = (c.hash, c.offset, size)
+                    if clip_key in needed_frames:
+                        num_frames = max(num_frames,
+                                         needed_frames[clip_key][2])
+                    needed_frames[clip_key] = (c, size, num_frames)
+
+                args = (instrument_clips, segment_placements,
+                        segment_needed_frames, frame_range, (w, h), fps,
+                        resize_filter, tmp_file_name)
+                cost = _estimate_segment_cost(segment_placements,
+                                              frame_range, (w, h), fps)
+                jobs.append(('{} [{}/{}]'.format(display_name, j + 1,
+                                                 len(segments)),
+                             cost, _process_segment, args))
+            track_segment_files[file_name] = segment_files
+
+    with tracing.span('decode frames'):
+        _warm_frame_cache(needed_frames.values(), fps, resize_filter)
+    num_segments = sum(len(f) for f in track_segment_files.values())
+    if len(jobs) < num_segments:
+        print("Reusing {} of {} segments".format(num_segments - len(jobs),
+                                                 num_segments))
+    with tracing.span('render segments'):
+        _run_jobs(jobs, num_threads)
+    for segment_file_name, tmp_file_name in rendered_segments.items():
+        filecache.publish(tmp_file_name, segment_file_name)
+    with tracing.span('concat segments'):
+        for file_name, segment_files in track_segment_files.items():
+            _concat_segments(segment_files, file_name)
+
+    filecache.evict(SEGMENT_CACHE_DIR, MAX_SEGMENT_CACHE_SIZE,
+                    '.' + INTERMEDIATE_EXTENSION)
+    filecache.evict(TRACK_CACHE_DIR, MAX_TRACK_CACHE_SIZE,
+                    '.' + INTERMEDIATE_EXTENSION)
+
+    with tracing.span('mix audio'):
+        has_audio = _mix_audio(analysed_tracks, instrument_names,
+                               all_instrument_clips, tempo_map, volumes,
+                               AUDIO_FILE_NAME, duration)
+
+    track_clips = [(edit.VideoFileClip(file_name, audio=False), tile)
+                   for file_name, tile in track_tiles]
+    grid_clip = _make_grid_clip(track_clips, (width, height), fps)
+    if has_audio:
+        grid_clip = grid_clip.set_audio(edit.AudioFileClip(AUDIO_FILE_NAME))
+    return grid_clip
+
+
+def _estimate_segment_cost(placements, frame_range, size, fps):
+    """
+    Estimates the relative time it takes to render a segment of a track.
+    Every frame of the segment is cleared and encoded, and every frame of
+    every note in it is drawn at the size of the note.
+    """
+    width, height = size
+    first, last = frame_range
+    cost = width*height*(last - first)
+    for (_, _, (w, h)), start, end, _ in placements:
+        duration = min(end, float(last)/fps) - max(start, float(first)/fps)
+        cost += w*h*max(duration, 0)*fps
+    return cost
 
-    # analysed_tracks :: {(name1, name2, ...): (notes, max_velocity)}
-    analysed_tracks = _analyse_all_tracks(midipattern, resolution)
 
-    track_clip_file_names = []
-    total_num_tracks = len(analysed_tracks)
-    processes = []
-    for instrument_names, (notes, max_velocity) in analysed_tracks.items():
-        
-        file_name = os.path.join(WORKING_DIR_NAME, '-'.join(instrument_names)
-                                 + '.mp4')
-        track_clip_file_names.append((len(notes), file_name))
-        queue = multiprocessing.Queue()
-        args = (instruments, instrument_names, source_dir, instrument_config,
-                notes, pulse_length, width, height, max_velocity,
-                queue, file_name, volumes, total_num_tracks)
-        process = multiprocessing.Process(target=_process_track, args=args)
-        processes.append((instrument_names, process, queue))
-
-    running_processes = []
-
-    progress_bar = bar.ChargingBar('', max=total_num_tracks)
-    done = False
-    num_processed_tracks = 0
-    while not done:
-        time.sleep(0.1)
-        done_instruments = []
-        for instrument_names, process, queue in running_processes:
-            while not queue.empty():
-                msg_type, contents = queue.get()
-                if msg_type == MSG_PROCESSED_SEGMENT:
-                    num_processed_tracks += 1
-                    progress_bar.next()
-                elif msg_type == MSG_DONE:
-                    done_instruments.append(instrument_names)
-                elif msg_type == MSG_FATAL_ERROR:
-                    raise contents
-
-        processes_changed = False
-
-        # remove the instruments that are done
-        for instrument_names in done_instruments:
-            index = 0
-            for i, (i_name, p, q) in enumerate(running_processes):
-                if instrument_names == i_name:
-                    index = i
-                    break
-            _, process, queue = running_processes.pop(index)
+def _print_running_jobs(running_jobs):
+    print('\nProcessing: ' + ', '.join(sorted(running_jobs)))
+
+
+def _run_jobs(jobs, num_processes):
+    """
+    Runs jobs, given as (name, cost, target, args) tuples, in at most
+    num_processes processes at a time, the most costly ones first so that
+    no long job is started last. Each job runs target(queue, *args), where
+    the target reports its progress on the queue. Returns a dictionary of
+    the contents of the MSG_DONE messages of the jobs, by name.
+    If a job fails, the other jobs are stopped and its error is raised.
+    """
+    pending_jobs = sorted(jobs, key=lambda j: j[1])
+    queue = multiprocessing.Queue()
+    running_jobs = {}
+    results = {}
+
+    progress_bar = bar.ChargingBar('', max=len(jobs))
+    try:
+        while pending_jobs or running_jobs:
+            started_jobs = False
+            while pending_jobs and len(running_jobs) < num_processes:
+                name, _, target, args = pending_jobs.pop()
+                process = multiprocessing.Process(
+                    target=target, args=(_JobQueue(queue, name),) + args)
+                process.start()
+                running_jobs[name] = process
+                started_jobs = True
+            if started_jobs:
+                _print_running_jobs(running_jobs)
+
+            try:
+                name, msg_type, contents = queue.get(
+                    timeout=CRASH_CHECK_INTERVAL)
+            except Empty:
+                # jobs report their own errors, so this only catches
+                # processes that were killed or crashed
+                for name, process in running_jobs.items():
+                    if process.exitcode not in (None, 0):
+                        raise Exception("Processing {} crashed with exit "
+                                        "code {}".format(name,
+                                                         process.exitcode))
+                continue
+
+            if msg_type == MSG_PROCESSED_SEGMENT:
+                progress_bar.next()
+            elif msg_type == MSG_TRACE:
+                tracing.merge(contents)
+            elif msg_type == MSG_DONE:
+                results[name] = contents
+                running_jobs.pop(name).join()
+            elif msg_type == MSG_FATAL_ERROR:
+                raise contents
+    finally:
+        for process in running_jobs.values():
+            process.terminate()
             process.join()
-            processes_changed = True
-
-        while len(running_processes) < num_threads and len(processes) > 0:
-            p = processes.pop()
-            p[1].start()
-            running_processes.append(p)
-            processes_changed = True
-
-        if not running_processes:
-            done = True
-
-        if processes_changed and not done:
-            progress_message = "Processing instruments: "
-            for names, _, _ in running_processes:
-                progress_message += '(' + ', '.join(names) + ')' + ', '
-            progress_message = '\n' + progress_message[:-2]
-            print(progress_message)
-    
+
     progress_bar.finish()
+    return results
 
-    track_clip_file_names.sort(key=lambda k: k[0], reverse=True)
 
-    final_clips = []
-    for i, (_, file_name) in enumerate(track_clip_file_names):
-        clip = edit.VideoFileClip(file_name)
-        x, y, w, h = _partition(width, height, len(track_clip_file_names), i)
-        final_clips.append(
-            fx.resize(clip, newsize=(w, h))
-            .set_position((x, y))
-        )
-    return edit.CompositeVideoClip(size=(width, height), clips=final_clips)
+class _JobQueue:
+    """
+    Queue that a job's process reports its progress on,
+    tagging every message with the job's name.
+    """
+
+    def __init__(self, queue, name):
+        self.queue = queue
+        self.name = name
+
+    def put(self, msg):
+        msg_type, contents = msg
+        if msg_type == MSG_DONE and tracing.is_enabled():
+            tracing.set_process_name(self.name)
+            self.queue.put((self.name, MSG_TRACE, tracing.take()))
+        self.queue.put((self.name, msg_type, contents))
+
+
+def _cut_to_time_range(analysed_tracks, tempo_map, time_range):
+    """
+    Removes the notes that don't sound during time_range = (start, end),
+    in seconds with end None for the end of the song, from all tracks.
+    The velocities and video positions of the remaining notes are left
+    as they were in the whole song. Returns a tempo map that counts
+    times from the start of the range, and the duration of the range.
+    """
+    start, end = time_range
+    if end is None:
+        end = max([tempo_map.to_seconds(notes['end']).max()
+                   for notes, _ in analysed_tracks.values() if len(notes)] +
+                  [start])
+    if end <= start:
+        raise ValueError("Nothing to render between {} and {} seconds".format(
+            start, end))
+    for names, (notes, max_velocity) in analysed_tracks.items():
+        starts, ends = _note_times(notes, tempo_map)
+        in_range = (starts < end) & (ends > start)
+        analysed_tracks[names] = (notes[in_range], max_velocity)
+    return tempo_map.shifted(start), end - start
 
 
 def _create_working_dir():
@@ -134,27 +391,32 @@ def _try_load_json_file(json_file_name):
         return json.loads(f.read())
 
 
-def _get_common_split_points(all_split_points, resolution):
-    common_split_points = []
-    if len(all_split_points) == 1:
-        common_split_points = list(all_split_points[0])
-    else:
-        first_split_points = all_split_points[0]
-        for point in first_split_points:
-            found = True
-            for split_points in all_split_points:
-                if point not in split_points:
-                    found = False
-                    break
-            if found:
-                common_split_points.append(point)
+def _get_common_split_points(tracks, resolution):
+    """
+    Returns the points in time (in ticks) where none of the tracks, given
+    as (notes, max_velocity) pairs, play a note and that are at least
+    MIN_NUM_MEASURES_BEFORE_SPLIT measures apart. The silences are found
+    by counting the playing notes over the sorted start and end times of
+    all notes. Notes that end when they start never sound, and are left
+    out so that they don't end other notes early.
+    """
+    sounding = [notes[notes['end'] > notes['start']] for notes, _ in tracks]
+    starts = np.concatenate([notes['start'] for notes in sounding])
+    ends = np.concatenate([notes['end'] for notes in sounding])
+    times = np.concatenate((ends, starts))
+    changes = np.concatenate((-np.ones(len(ends), dtype=np.int64),
+                              np.ones(len(starts), dtype=np.int64)))
+    # at the same time, notes end before others start
+    order = np.lexsort((changes, times))
+    num_playing = np.cumsum(changes[order])
+    common_split_points = times[order][num_playing == 0].tolist()
 
     min_num_ticks_to_split = resolution*MIN_NUM_MEASURES_BEFORE_SPLIT*4
 
     filtered_points = []
     last_split = float('-inf')
 
-    for point in sorted(common_split_points):
+    for point in common_split_points:
         if point - last_split >= min_num_ticks_to_split:
             filtered_points.append(point)
             last_split = point
@@ -162,65 +424,174 @@ def _get_common_split_points(all_split_points, resolution):
     return filtered_points
 
 
-def _num_overlapping_notes(track1, track2):
+def _plan_segments(split_points, tempo_map, num_frames, fps):
+    """
+    Splits the frames of a track into (first, last + 1) ranges to render
+    separately. The track is split at the given split points (in ticks),
+    and pieces longer than MAX_SEGMENT_DURATION seconds are cut into
+    segments of that length from their start, so that when a piece gets
+    longer or shorter only its last segment changes. Notes that sound
+    across a split are drawn in both segments.
     """
-    Returns the number of notes in the given tracks that overlap.
-    The given lists of tracks must be sorted by start time.
+    boundaries = set([0, num_frames])
+    for seconds in tempo_map.to_seconds(split_points):
+        frame = int(round(seconds*fps))
+        if 0 < frame < num_frames:
+            boundaries.add(frame)
+    boundaries = sorted(boundaries)
+
+    max_segment_frames = int(MAX_SEGMENT_DURATION*fps)
+    segments = []
+    for first, last in zip(boundaries, boundaries[1:]):
+        for start in range(first, last, max_segment_frames):
+            segments.append((start, min(start + max_segment_frames, last)))
+    return segments
+
+
+def _placements_in_range(placements, frame_range, fps):
     """
-    res = 0
-    for n1 in track1:
-        for n2 in track2:
-            if n2.start > n1.end:
-                break
-            elif n1.start == n2.start or n1.end == n2.end:
-                res += 1
-            elif n1.start < n2.start:
-                if n1.end > n2.start:
-                    res += 1
-            elif n1.end > n2.end:
-                if n1.start < n2.end:
-                    res += 1
+    Returns the placements of the notes that sound during the frame range.
+    """
+    first, last = frame_range
+    range_start = float(first)/fps
+    range_end = float(last)/fps
+    return [p for p in placements if p[1] < range_end and p[2] > range_start]
 
-    return res
 
+def _concat_segments(segment_files, file_name):
+    """
+    Joins the rendered segments of a track into one file with ffmpeg's
+    concat demuxer, without encoding them again. The segments are kept.
+    """
+    tmp_file_name = filecache.temporary_file_name(file_name)
+    if len(segment_files) == 1:
+        shutil.copyfile(segment_files[0], tmp_file_name)
+    else:
+        list_file_name = filecache.temporary_file_name(file_name + '.txt')
+        with open(list_file_name, 'w') as f:
+            for segment_file in segment_files:
+                f.write("file '{}'\n".format(os.path.abspath(segment_file)))
+        cmd = [get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+               '-f', 'concat', '-safe', '0', '-i', list_file_name,
+               '-c', 'copy', tmp_file_name]
+        sp.check_call(cmd)
+        os.remove(list_file_name)
+    filecache.publish(tmp_file_name, file_name)
+
+
+def _decode_note_frames(args):
+    clip, sizes, fps, num_frames, resize_filter = args
+    try:
+        framecache.cache_frames(FRAME_CACHE_DIR, clip, sizes, fps,
+                                num_frames, resize_filter)
+    finally:
+        framecache.close_readers()
 
-def _merge_tracks_with_min_overlap(analysed_tracks):
-    """
-    Merges the two least overlapping tracks 
-    """
-    pairs = []
-    for name1 in analysed_tracks:
-        for name2 in analysed_tracks:
-            track1, _ = analysed_tracks[name1]
-            track2, _ = analysed_tracks[name2]
-            overlap = _num_overlapping_notes(track1, track2)
-            pairs.append((name1, name2, overlap))
-    name1, name2, overlap = min(pairs, key=lambda k: k[2])
-    track1, max_velocity1 = analysed_tracks[name1]
-    track2, max_velocity2 = analysed_tracks[name2]
-    del analysed_tracks[name1]
-    del analysed_tracks[name2]
-    analysed_tracks[name1 + name2] = (sorted(track1 + track2, 
-                                             key=lambda n: n.start), 
-                                      max(max_velocity1, max_velocity2))
 
-    
+def _warm_frame_cache(needed_frames, fps, resize_filter):
+    """
+    Decodes the frames of all note clips that the segments need and that
+    aren't cached yet on all cores, so that the segments of a track don't
+    all decode the same clips. The frames are given as
+    (clip, size, number of frames) tuples. Every clip is decoded once,
+    for all the sizes it's missing at.
+    """
+    # {(clip hash, offset): (clip, sizes, number of frames)}
+    missing_frames = {}
+    for clip, size, num_frames in needed_frames:
+        if framecache.is_cached(FRAME_CACHE_DIR, clip, size, fps, num_frames,
+                                resize_filter):
+            continue
+        key = (clip.hash, clip.offset)
+        if key in missing_frames:
+            _, sizes, other_num_frames = missing_frames[key]
+            num_frames = max(num_frames, other_num_frames)
+        else:
+            sizes = []
+        sizes.append(size)
+        missing_frames[key] = (clip, sizes, num_frames)
+    if not missing_frames:
+        return
+    print("Decoding {} note clips".format(len(missing_frames)))
+    pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    try:
+        tracing.pool_map(pool, _decode_note_frames,
+                         [(clip, sizes, fps, num_frames, resize_filter)
+                          for clip, sizes, num_frames
+                          in missing_frames.values()])
+    finally:
+        pool.close()
+        pool.join()
 
 
-def _merge_analysed_tracks(analysed_tracks):
+def _overlap_matrix(tracks):
     """
-    Merges the tracks of analysed_tracks that don't overlap with eachother.
+    Returns a matrix with the number of pairs of notes from track i and
+    track j that sound at the same time, for the given note tables.
+    The notes of track j that overlap a note of track i are the ones
+    that start before it ends, except the ones that end before it starts,
+    which are counted for all notes at once with binary searches in the
+    sorted starts and ends of track j. The diagonal is meaningless.
     """
-    while len(analysed_tracks.keys()) > MAX_NUM_SIM_TRACKS:
-        _merge_tracks_with_min_overlap(analysed_tracks)
+    sounding = [notes[notes['end'] > notes['start']] for notes in tracks]
+    starts = [np.sort(notes['start']) for notes in sounding]
+    ends = [np.sort(notes['end']) for notes in sounding]
+
+    overlaps = np.zeros((len(tracks), len(tracks)))
+    for i in range(len(tracks)):
+        for j in range(i + 1, len(tracks)):
+            overlap = (np.searchsorted(starts[j], ends[i], 'left').sum() -
+                       np.searchsorted(ends[j], starts[i], 'right').sum())
+            overlaps[i, j] = overlap
+            overlaps[j, i] = overlap
+    return overlaps
+
 
+def _merge_tracks(analysed_tracks, name1, name2):
+    """
+    Replaces two tracks of analysed_tracks with one that plays both.
+    """
+    track1, max_velocity1 = analysed_tracks.pop(name1)
+    track2, max_velocity2 = analysed_tracks.pop(name2)
+    analysed_tracks[name1 + name2] = (midiparse.merge_note_tables(track1,
+                                                                  track2),
+                                      max(max_velocity1, max_velocity2))
 
-def _analyse_all_tracks(midipattern, resolution):
-    total_num_ticks = midiparse.get_total_num_ticks(midipattern)
-    analysed_tracks = {(midiparse.get_instrument_name(miditrack),): 
-                       midiparse.analyse_track(miditrack, total_num_ticks)
-                       for miditrack in filter(midiparse.has_notes,
-                                               midipattern)}
+
+def _merge_analysed_tracks(analysed_tracks):
+    """
+    Merges the two tracks of analysed_tracks that overlap the least with
+    eachother until there are at most MAX_NUM_SIM_TRACKS tracks. The overlaps
+    are counted once, after which the overlaps of a merged track are
+    the sums of the overlaps of its parts.
+    """
+    if len(analysed_tracks) <= MAX_NUM_SIM_TRACKS:
+        return
+    names = list(analysed_tracks.keys())
+    overlaps = _overlap_matrix([analysed_tracks[name][0] for name in names])
+    np.fill_diagonal(overlaps, np.inf)
+
+    while len(names) > MAX_NUM_SIM_TRACKS:
+        i, j = sorted(np.unravel_index(np.argmin(overlaps), overlaps.shape))
+        _merge_tracks(analysed_tracks, names[i], names[j])
+
+        keep = [k for k in range(len(names)) if k != i and k != j]
+        merged_overlaps = (overlaps[i] + overlaps[j])[keep]
+        num_tracks = len(keep) + 1
+        new_overlaps = np.empty((num_tracks, num_tracks))
+        new_overlaps[:-1, :-1] = overlaps[np.ix_(keep, keep)]
+        new_overlaps[-1, :-1] = merged_overlaps
+        new_overlaps[:-1, -1] = merged_overlaps
+        new_overlaps[-1, -1] = np.inf
+        overlaps = new_overlaps
+        names = [names[k] for k in keep] + [names[i] + names[j]]
+
+
+def _analyse_all_tracks(song):
+    analysed_tracks = {(name,): (notes.copy(),
+                                 notes['velocity'].max() if len(notes) else 0)
+                       for name, notes in zip(song.instrument_names,
+                                              song.tracks)}
     _merge_analysed_tracks(analysed_tracks)
     for track, _ in analysed_tracks.values():
         midiparse.assign_video_positions(track)
@@ -282,6 +653,10 @@ def _map_notes(avail_tones, instrument_notes):
 
 
 def _try_load_offset_file(instrument_dir):
+    """
+    Loads the offsets that older versions stored next to the clips,
+    mapped by note number.
+    """
     file_name = os.path.join(instrument_dir, OFFSET_FILE_NAME)
     if os.path.isfile(file_name):
         with open(file_name) as f:
@@ -290,13 +665,13 @@ def _try_load_offset_file(instrument_dir):
     return {}
 
 
-def _write_offset_file(instrument_dir, offset):
-    with open(os.path.join(instrument_dir, OFFSET_FILE_NAME), 'w') as f:
-        f.write(json.dumps(offset))
-
-
-def _load_instrument_clips(instrument_name, instrument_notes, 
-                           source_dir, instrument_config):
+def _find_instrument_clips(instrument_name, instrument_notes, 
+                           source_dir, instrument_config, library):
+    """
+    Maps every note the instrument plays to the ClipInfo of the clip
+    to use for it. Clips that were analysed by older versions get
+    their offsets from the offset file.
+    """
     res = {}
     instrument_path = None
     if instrument_config is not None:
@@ -304,47 +679,68 @@ def _load_instrument_clips(instrument_name, instrument_notes,
     else:
         instrument_path = os.path.join(source_dir, instrument_name)
 
-    min_vol = float('inf')
     avail_tones = _get_available_tones(instrument_path)
     mapped_notes = _map_notes(avail_tones, instrument_notes)
 
-    while True:
-        try:
-            offset_map = _try_load_offset_file(instrument_path)
-            break
-        except IOError:
-            time.sleep(1)
-        
-
-    edited_offset_map = False
+    legacy_offset_map = None
 
     for note_number, note_str in mapped_notes.items():
-        # note_str = midiparse.note_number_to_note_string(note_number)
-
         file_name = os.path.join(instrument_path, 
                                  note_str + ".mp4")
+        clip_info = library.get_clip(file_name)
 
-        clip = edit.VideoFileClip(file_name)
-        tmp_file = os.path.join(WORKING_DIR_NAME,
-                                'STUPIDMOVIEPY' + note_str + instrument_name + '.mp4')
+        if not clip_info.is_analysed():
+            if legacy_offset_map is None:
+                legacy_offset_map = _try_load_offset_file(instrument_path)
+            if note_number in legacy_offset_map:
+                offset, max_vol = legacy_offset_map[note_number]
+                library.store_analysis(clip_info, offset, max_vol)
 
-        offset, max_vol = None, None
-        if offset_map is not None and note_number in offset_map:
-            offset, max_vol = offset_map[note_number]
-        else:
-            offset, max_vol = audioanalysis.find_offset_and_max_vol(clip)
-            clip.write_videofile(tmp_file, progress_bar=False, verbose=False)
-            offset_map[note_number] = (offset, max_vol)
-            edited_offset_map = True
-            os.remove(tmp_file)
+        res[note_number] = clip_info
 
-        res[note_number] = (clip, offset, max_vol)
-        min_vol = min(min_vol, max_vol)
+    return res
 
-    if edited_offset_map:
-        _write_offset_file(instrument_path, offset_map)
 
-    return res, min_vol
+def _load_instrument_clips(instruments, source_dir, instrument_config,
+                           library):
+    """
+    Maps the notes of every instrument to the clips to use for them,
+    and analyses all clips that haven't been analysed before on
+    all cores. Returns {instrument name: (clips, min_vol)}, where
+    min_vol is the lowest peak volume of the instrument's clips.
+    """
+    found_clips = {name: _find_instrument_clips(name, notes, source_dir,
+                                                instrument_config, library)
+                   for name, notes in instruments.items()}
+
+    # the same recording can be used by several notes and instruments
+    unanalysed_clips = {}
+    for clips in found_clips.values():
+        for clip in clips.values():
+            tracing.count('clip analysis', clip.is_analysed())
+            if not clip.is_analysed():
+                unanalysed_clips.setdefault(clip.hash, []).append(clip)
+
+    if unanalysed_clips:
+        print("Analysing {} note clips".format(len(unanalysed_clips)))
+        clip_groups = list(unanalysed_clips.values())
+        pool = multiprocessing.Pool(multiprocessing.cpu_count())
+        try:
+            results = tracing.pool_map(
+                pool, audioanalysis.analyse_file,
+                [clips[0].file_name for clips in clip_groups])
+        finally:
+            pool.close()
+            pool.join()
+        for clips, (offset, max_vol, envelope) in zip(clip_groups, results):
+            library.store_analysis(clips[0], offset, max_vol, envelope)
+            for clip in clips[1:]:
+                clip.offset = clips[0].offset
+                clip.max_vol = clips[0].max_vol
+                clip.envelope = clips[0].envelope
+
+    return {name: (clips, min(c.max_vol for c in clips.values()))
+            for name, clips in found_clips.items()}
 
 
 def _partition(width, height, num_sim_notes, pos):
@@ -389,61 +785,299 @@ def _partition(width, height, num_sim_notes, pos):
         return (pos // 3)*w, (pos % 3)*h, w, h
 
 
-def _process_track(instruments, instrument_names, source_dir, 
-                   instrument_config,
-                   notes, pulse_length,
-                   width, height, max_velocity, 
-                   queue, file_name, volumes, num_sim_tracks):
+def _blit(frame, picture, x, y):
     """
-    Composes one midi track into a stop motion video clip.
-    Writes a file of this with the given file name.
+    Copies picture into frame with its top left corner at (x, y),
+    cropping whatever falls outside of the frame.
     """
-    try:
-        instrument_clips = {name: _load_instrument_clips(name, 
-                                                         instruments[name],
-                                                         source_dir,
-                                                         instrument_config)
-                           for name in instrument_names}
-        parsed_clips = []
-        scale_factor = int(math.floor(math.log(num_sim_tracks, 2) + 1))
-        if os.path.isfile(file_name):
-            queue.put((MSG_PROCESSED_SEGMENT, 0))
-            queue.put((MSG_DONE, 1))
-            return
-        for note in notes:
-            note_number = note.note_number
-            clips, min_vol = instrument_clips[note.instrument_name]
+    frame_h, frame_w = frame.shape[:2]
+    pic_h, pic_w = picture.shape[:2]
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + pic_w, frame_w), min(y + pic_h, frame_h)
+    if x1 >= x2 or y1 >= y2:
+        return
+    frame[y1:y2, x1:x2] = picture[y1 - y:y2 - y, x1 - x:x2 - x]
+
+
+class _FrameBuffers:
+    """
+    Preallocated frames of the given size that are drawn in turn, so that
+    a frame is only drawn over again after num_frames more have been drawn.
+    The pictures are opaque and axis aligned, so a frame is only cleared
+    where it showed pictures the last time it was drawn that aren't
+    drawn over again.
+    """
+
+    def __init__(self, size, num_frames):
+        width, height = size
+        self.frames = [np.zeros((height, width, 3), dtype=np.uint8)
+                       for _ in range(num_frames)]
+        # (x, y, w, h) of the pictures last drawn in every frame
+        self.drawn_tiles = [set() for _ in range(num_frames)]
+        self.next_frame = 0
+
+    def draw(self, pictures):
+        """
+        Returns the next frame, with the pictures, given as
+        (picture, x, y) tuples, drawn in order on black.
+        """
+        i = self.next_frame
+        self.next_frame = (i + 1) % len(self.frames)
+        frame = self.frames[i]
+        tiles = set((x, y, picture.shape[1], picture.shape[0])
+                    for picture, x, y in pictures)
+        for x, y, w, h in self.drawn_tiles[i] - tiles:
+            frame[max(y, 0):max(y + h, 0), max(x, 0):max(x + w, 0)] = 0
+        for picture, x, y in pictures:
+            _blit(frame, picture, x, y)
+        self.drawn_tiles[i] = tiles
+        return frame
+
+
+def _note_times(notes, tempo_map):
+    """
+    Returns the start and end times in seconds of the notes of a table.
+    """
+    return (tempo_map.to_seconds(notes['start']),
+            tempo_map.to_seconds(notes['end']))
+
+
+def _place_notes(notes, instrument_names, instrument_clips, tempo_map, size,
+                 fps):
+    """
+    Works out when and where in a tile of the given size the clip of
+    every note of a track is shown. Returns the placements of the notes
+    as (frames key, start, end, position) tuples, where the frames key is
+    (instrument name, note number, size), along with the number of frames
+    needed of every frames key.
+    """
+    width, height = size
+    placements = []
+    needed_frames = {}
+    starts, ends = _note_times(notes, tempo_map)
+    for pitch, instrument, num_sim_notes, video_position, start, end in zip(
+            notes['pitch'].tolist(), notes['instrument'].tolist(),
+            notes['num_sim_notes'].tolist(), notes['video_position'].tolist(),
+            starts.tolist(), ends.tolist()):
+        name = instrument_names[instrument]
+        c = instrument_clips[name][0][pitch]
+        x, y, w, h = _partition(width, height, num_sim_notes, video_position)
+
+        duration = min(end - start, c.duration - c.offset)
+        frames_key = (name, pitch, (w, h))
+        num_frames = int(math.ceil(duration*fps)) + 1
+        needed_frames[frames_key] = max(needed_frames.get(frames_key, 0),
+                                        num_frames)
+        placements.append((frames_key, start, start + duration, (x, y)))
+    return placements, needed_frames
+
+
+def _render_frames(placements, note_frames, frame_range, size, fps,
+                   num_buffers=1):
+    """
+    Generates the frames in frame_range = (first, last + 1) of a track at
+    fps from the placements of its notes, given the already resized frames
+    of every note clip from its onset. Every frame only draws the notes
+    that sound at that time. The frames are drawn in num_buffers
+    preallocated buffers in turn, so a frame is only valid until
+    num_buffers more are generated.
+    """
+    index = noteindex.ActiveNoteIndex([p[1] for p in placements],
+                                      [p[2] for p in placements])
+    buffers = _FrameBuffers(size, num_buffers)
+    first, last = frame_range
+    for frame_number in range(first, last):
+        t = float(frame_number)/fps
+        pictures = []
+        for i in index.active_at(t):
+            frames_key, start, _, (x, y) = placements[i]
+            frames = note_frames[frames_key]
+            frame_index = min(int((t - start)*fps + 1e-6), len(frames) - 1)
+            pictures.append((frames[frame_index], x, y))
+        yield buffers.draw(pictures)
+
+
+def _make_grid_clip(track_clips, size, fps):
+    """
+    Creates the final clip from the rendered tracks, given as
+    (clip, (x, y, w, h)) pairs. The track clips already have the size
+    of their tiles, so their frames are copied into the grid as they are.
+    The frames are drawn in preallocated buffers, enough of them for a
+    videowriter.VideoWriter to encode the frames it's given.
+    """
+    buffers = _FrameBuffers(size, videowriter.MAX_FRAMES_IN_USE + 1)
+
+    def make_frame(t):
+        return buffers.draw([(clip.get_frame(t), x, y)
+                             for clip, (x, y, _, _) in track_clips
+                             if t < clip.duration])
+
+    grid_clip = edit.VideoClip(make_frame)
+    grid_clip = grid_clip.set_duration(max(c.duration for c, _ in track_clips))
+    return grid_clip.set_fps(fps)
+
+
+def _load_note_audio(args):
+    clip, max_duration = args
+    return audiomixing.load_clip_audio(clip.file_name, clip.offset,
+                                       max_duration)
+
+
+def _mix_audio(analysed_tracks, instrument_names, instrument_clips, tempo_map,
+               volumes, file_name, max_duration=None):
+    """
+    Mixes the audio of the notes of all tracks into a wav file with the
+    given name, at most max_duration seconds long if given. The audio of
+    every note clip is only read once, from its offset and as far as its
+    longest note needs it. Returns whether any of the notes had audio.
+    """
+    # {clip hash: (clip, longest duration it plays)}
+    needed_audio = {}
+    # [(clip hash, start, duration, gain)]
+    sounds = []
+    song_duration = 0
+    for notes, max_velocity in analysed_tracks.values():
+        starts, ends = _note_times(notes, tempo_map)
+        for pitch, instrument, velocity, start, end in zip(
+                notes['pitch'].tolist(), notes['instrument'].tolist(),
+                notes['velocity'].tolist(), starts.tolist(), ends.tolist()):
+            name = instrument_names[instrument]
+            clips, min_vol = instrument_clips[name]
             vol = 0.5
             if volumes is not None:
-                vol = volumes.get(note.instrument_name, 0.5)
-
-            c, offset, max_vol = clips[note_number]
-            clip = c.copy()
-            num_sim_notes = note.get_num_sim_notes()
-
-            x, y, w, h = _partition(width, height, 
-                                    num_sim_notes, note.video_position)
-
-            volume = (float(note.velocity)/float(max_velocity))*(min_vol/max_vol)
-
-            clip = clip.subclip(offset)
-            clip = clip.set_start((note.start)*pulse_length)
-            clip = clip.volumex(volume*vol)
-            d = clip.duration
-            clip = clip.set_duration(min(note.duration*pulse_length, d))
-            clip = clip.set_position((x//scale_factor, y//scale_factor))
-            clip = fx.resize(clip, newsize=(w//scale_factor, h//scale_factor))
-            parsed_clips.append(clip)
-        track_clip = edit.CompositeVideoClip(size=(width//scale_factor,
-                                                   height//scale_factor), 
-                                             clips=parsed_clips)
-        track_clip.write_videofile(file_name, fps=30,
-                                   verbose=False, progress_bar=False)
+                vol = volumes.get(name, 0.5)
+
+            c = clips[pitch]
+            duration = min(end - start, c.duration - c.offset)
+            song_duration = max(song_duration, start + duration)
+            if not c.has_audio:
+                continue
+
+            volume = (float(velocity)/float(max_velocity))*(min_vol/c.max_vol)
+            sounds.append((c.hash, start, duration, volume*vol))
+            if c.hash not in needed_audio or needed_audio[c.hash][1] < duration:
+                needed_audio[c.hash] = (c, duration)
+
+    if not sounds:
+        return False
+    if max_duration is not None:
+        song_duration = min(song_duration, max_duration)
+
+    hashes = list(needed_audio.keys())
+    pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    try:
+        samples = tracing.pool_map(pool, _load_note_audio,
+                                   [needed_audio[h] for h in hashes])
+    finally:
+        pool.close()
+        pool.join()
+    samples = dict(zip(hashes, samples))
+
+    mixed = audiomixing.mix([(samples[h], start, duration, gain)
+                             for h, start, duration, gain in sounds],
+                            song_duration)
+    tmp_file_name = filecache.temporary_file_name(file_name)
+    audiomixing.write_wav(tmp_file_name, mixed)
+    filecache.publish(tmp_file_name, file_name)
+    return True
+
+
+def _track_cache_key(notes, instrument_names, instrument_clips, tempo_map,
+                     size, duration, fps, resize_filter):
+    """
+    Returns a hash of everything that the rendered video of a track depends
+    on: its notes, timing, size, length and the contents of the note clips.
+    The audio is mixed separately, so volumes don't matter.
+    """
+    clips = {}
+    for name, (note_clips, _) in instrument_clips.items():
+        clips[name] = sorted((note_number, c.hash, c.offset)
+                             for note_number, c in note_clips.items())
+    columns = ['pitch', 'start', 'end', 'instrument',
+               'video_position', 'num_sim_notes']
+    notes_hash = hashlib.sha1(np.stack([notes[column].astype(np.int64)
+                                        for column in columns]).tostring())
+    description = {
+        'version': TRACK_CACHE_VERSION,
+        'notes': notes_hash.hexdigest(),
+        'instrument_names': {str(i): instrument_names[i]
+                             for i in np.unique(notes['instrument'])},
+        'tempo': [tempo_map.tempo_changes, list(tempo_map.pulse_lengths),
+                  tempo_map.offset],
+        'size': size,
+        'duration': duration,
+        'instruments': clips,
+        'fps': fps,
+        'resize': resize_filter,
+        'codec': INTERMEDIATE_CODEC,
+    }
+    encoded = json.dumps(description, sort_keys=True)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _segment_cache_key(instrument_clips, placements, frame_range, size, fps,
+                       resize_filter):
+    """
+    Returns a hash of everything that a rendered segment of a track
+    depends on: the frame range, the placements of the notes that sound
+    during it and the contents of their clips.
+    """
+    notes = []
+    for (name, note_number, note_size), start, end, position in placements:
+        c = instrument_clips[name][0][note_number]
+        notes.append([c.hash, c.offset, note_size, start, end, position])
+    description = {
+        'version': TRACK_CACHE_VERSION,
+        'notes': notes,
+        'frame_range': frame_range,
+        'size': size,
+        'fps': fps,
+        'codec': INTERMEDIATE_CODEC,
+        'resize': resize_filter,
+    }
+    encoded = json.dumps(description, sort_keys=True)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _process_segment(queue, instrument_clips, placements, needed_frames,
+                     frame_range, size, fps, resize_filter, file_name):
+    """
+    Composes the frames in frame_range of one midi track into a stop motion
+    video of the given size and frame rate, from the placements of the
+    notes that sound during them. Writes it to a file with the given name,
+    losslessly encoded so that the final render is the only lossy encode.
+    """
+    try:
+        note_frames = {}
+        with tracing.span('load frames'):
+            for frames_key, num_frames in needed_frames.items():
+                name, note_number, frames_size = frames_key
+                c = instrument_clips[name][0][note_number]
+                note_frames[frames_key] = framecache.get_frames(
+                    FRAME_CACHE_DIR, c, frames_size, fps, num_frames,
+                    resize_filter)
+            framecache.close_readers()
+
+        first, last = frame_range
+        with tracing.span('render segment', frames=last - first) as args:
+            writer = videowriter.VideoWriter(file_name, size, fps,
+                                             INTERMEDIATE_CODEC)
+            # the time spent waiting for the encoder to catch up
+            encode_wait_time = 0.0
+            for frame in _render_frames(placements, note_frames, frame_range,
+                                        size, fps,
+                                        videowriter.MAX_FRAMES_IN_USE + 1):
+                start = time.time()
+                writer.write_frame(frame)
+                encode_wait_time += time.time() - start
+            start = time.time()
+            writer.close()
+            args['encode wait seconds'] = (encode_wait_time + time.time() -
+                                           start)
 
         queue.put((MSG_PROCESSED_SEGMENT, 0))
-        queue.put((MSG_DONE, 1))
+        queue.put((MSG_DONE, file_name))
 
     except Exception as e:
         queue.put((MSG_FATAL_ERROR, e))
         traceback.print_exc(file=sys.stdout)
-
@@ -0,0 +1,154 @@
+import subprocess as sp
+import tempfile
+import threading
+import time
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import progress.bar as bar
+from moviepy.config import get_setting
+import tracing
+
+# frames waiting to be encoded. While ffmpeg encodes one frame the next
+# one is composed, and more frames in between would only use memory
+QUEUE_SIZE = 2
+
+# frames that a writer can hold on to at once, the queued ones and
+# the one being sent to ffmpeg
+MAX_FRAMES_IN_USE = QUEUE_SIZE + 1
+
+DEFAULT_CODEC = 'libx264'
+DEFAULT_PRESET = 'medium'
+AUDIO_CODEC = 'aac'
+
+
+class VideoWriter:
+    """
+    Encodes frames into a video file with one ffmpeg process. The frames
+    are handed to a background thread through a bounded queue and written
+    to ffmpeg from there, so that the next frame is composed while ffmpeg
+    encodes the previous one. A frame must not be changed until
+    MAX_FRAMES_IN_USE more have been written after it. The audio is taken
+    from audio_file_name, if given, and the pixel format is left to ffmpeg
+    unless pix_fmt is given.
+    """
+
+    def __init__(self, file_name, size, fps, codec=DEFAULT_CODEC, preset=None,
+                 crf=None, threads=None, audio_file_name=None, pix_fmt=None):
+        self.file_name = file_name
+        width, height = size
+        cmd = [get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-vcodec', 'rawvideo',
+               '-s', '{}x{}'.format(width, height), '-pix_fmt', 'rgb24',
+               '-r', '{:.02f}'.format(fps), '-i', '-']
+        if audio_file_name is not None:
+            cmd.extend(['-i', audio_file_name, '-map', '0:v', '-map', '1:a',
+                        '-acodec', AUDIO_CODEC])
+        cmd.extend(['-vcodec', codec])
+        if preset is not None:
+            cmd.extend(['-preset', preset])
+        if crf is not None:
+            cmd.extend(['-crf', str(crf)])
+        if threads is not None:
+            cmd.extend(['-threads', str(threads)])
+        if pix_fmt is not None:
+            cmd.extend(['-pix_fmt', pix_fmt])
+        cmd.append(file_name)
+
+        # ffmpeg's errors are written to a file rather than a pipe, which
+        # ffmpeg would block on once it's full
+        self.error_file = tempfile.TemporaryFile()
+        self.proc = sp.Popen(cmd, stdin=sp.PIPE, stderr=self.error_file)
+        self.queue = Queue(QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write_frames(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            if self.error is not None:
+                # keep taking frames so that write_frame doesn't block
+                continue
+            try:
+                self.proc.stdin.write(frame.data)
+            except IOError as e:
+                self.error = e
+
+    def write_frame(self, frame):
+        """
+        Queues a (height, width, 3) uint8 frame for encoding, waiting
+        while the queue is full.
+        """
+        if self.error is not None:
+            self.close()
+        if not frame.flags['C_CONTIGUOUS']:
+            frame = frame.copy()
+        self.queue.put(frame)
+
+    def close(self):
+        """
+        Waits until all frames are encoded and the file is written.
+        """
+        if self.proc is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.proc.stdin.close()
+        self.proc.wait()
+        returncode = self.proc.returncode
+        self.proc = None
+        self.error_file.seek(0)
+        err = self.error_file.read()
+        self.error_file.close()
+        if self.error is not None or returncode != 0:
+            raise IOError("ffmpeg could not write {}: {}".format(
+                self.file_name, err or self.error))
+
+
+def write_clip(clip, file_name, codec=DEFAULT_CODEC, preset=DEFAULT_PRESET,
+               crf=None, threads=None):
+    """
+    Writes a moviepy clip at its frame rate, with the audio of the file
+    that its audio clip reads, if it has one. The video is stored as
+    yuv420p, which all players support, if its size allows it. The time
+    spent making the frames of the clip and waiting for the encoder are
+    traced separately, as arguments of the 'write video' span.
+    """
+    audio_file_name = getattr(clip.audio, 'filename', None)
+    width, height = clip.size
+    pix_fmt = None
+    if width % 2 == 0 and height % 2 == 0:
+        pix_fmt = 'yuv420p'
+    num_frames = int(clip.duration*clip.fps)
+    progress_bar = bar.ChargingBar('Writing ' + file_name, max=num_frames)
+    with tracing.span('write video') as args:
+        writer = VideoWriter(file_name, clip.size, clip.fps, codec, preset,
+                             crf, threads, audio_file_name, pix_fmt)
+        composite_time = 0.0
+        encode_wait_time = 0.0
+        try:
+            frames = clip.iter_frames(dtype='uint8')
+            while True:
+                start = time.time()
+                frame = next(frames, None)
+                composite_time += time.time() - start
+                if frame is None:
+                    break
+                start = time.time()
+                writer.write_frame(frame)
+                encode_wait_time += time.time() - start
+                progress_bar.next()
+        finally:
+            start = time.time()
+            writer.close()
+            encode_wait_time += time.time() - start
+        args['composite seconds'] = composite_time
+        args['encode wait seconds'] = encode_wait_time
+    progress_bar.finish()